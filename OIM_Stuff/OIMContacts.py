@@ -0,0 +1,147 @@
+""" Registry of the people in the ContactLists of an OIM topology.
+
+The same people turn up in the contact lists of hundreds of resources.  ContactRegistry stores each person once, keeps
+for every resource, resource group and facility the people in its contact lists by ContactType and ContactRank (in the
+order they were first seen), and indexes the other way round, from a person to the resources, resource groups and
+facilities they are a contact for.  Every operation is a dictionary lookup, so building and querying it scales to the
+whole grid.  Pass one to OIMTopology.OIMTopology(xml_file, contact_registry=ContactRegistry()) and it is filled in as
+the file is parsed.
+"""
+
+import collections
+
+RESOURCE = 'resource'
+GROUP = 'group'
+FACILITY = 'facility'
+levels = (RESOURCE, GROUP, FACILITY)
+
+# Order of the ContactRank values, for sorting
+rank_order = {'Primary': 0, 'Secondary': 1, 'Tertiary': 2}
+
+# A person in the contact lists.  Email is None until OIM gives it out again
+Person = collections.namedtuple('Person', ['name', 'email'])
+
+
+class ContactRegistry(object):
+    """Contacts of the resources, resource groups and facilities of a topology.  Entities are identified by
+    (<level>, <OIM ID>), where level is RESOURCE, GROUP or FACILITY.  A contact of an entity is a (<ContactType>,
+    <ContactRank>, <name>) key, and each entity keeps a count of the resources it has a key from, so that removing a
+    resource group only removes the contacts nothing else still provides"""
+    def __init__(self):
+        self.people = {}                            # {<name>: Person}
+        self.entities = {}                          # {(<level>, <id>): OrderedDict {(<type>, <rank>, <name>):
+                                                    #   <count>}}
+        self.reverse = {}                           # {<name>: OrderedDict {(<level>, <id>): <count>}}
+        self.parents = collections.OrderedDict()    # {<resource id>: (<group id>, <facility id>)}, in the order the
+                                                    #   resources were added
+        self.group_resources = {}                   # {<group id>: OrderedDict {<resource id>: None}}
+
+    def person(self, name):
+        """Returns the Person called name, adding them if they are new"""
+        try:
+            return self.people[name]
+        except KeyError:
+            person = self.people[name] = Person(name, None)
+            return person
+
+    def add_resource(self, resource_id, group_id, facility_id, contactlists):
+        """Adds the contacts of a resource, and through it of its resource group and facility.  contactlists is a list
+        of {'ContactType': <type>, 'Contacts': [{'Name': <name>, 'ContactRank': <rank>}]} dictionaries, as extracted by
+        OIMTopology.CONTACT_LIST_EXTRACTOR.  A resource that is already registered is replaced"""
+        if resource_id in self.parents:
+            self.remove_resource(resource_id)
+        self.parents[resource_id] = (group_id, facility_id)
+        self.group_resources.setdefault(group_id, collections.OrderedDict())[resource_id] = None
+
+        entities = ((RESOURCE, resource_id), (GROUP, group_id), (FACILITY, facility_id))
+        for contactlist in contactlists:
+            for contact in contactlist['Contacts']:
+                name = self.person(contact['Name']).name
+                key = (contactlist['ContactType'], contact['ContactRank'], name)
+                for entity in entities:
+                    self._incr(self.entities, entity, key, 1)
+                    self._incr(self.reverse, name, entity, 1)
+
+    def remove_resource(self, resource_id):
+        """Removes a resource and whatever contacts of its resource group and facility only it provided"""
+        group_id, facility_id = self.parents.pop(resource_id)
+        resources = self.group_resources[group_id]
+        del resources[resource_id]
+        if not resources:
+            del self.group_resources[group_id]
+
+        entity = (RESOURCE, resource_id)
+        for key, count in self.entities.pop(entity, {}).iteritems():
+            name = key[2]
+            self._incr(self.reverse, name, entity, -count)
+            for parent in ((GROUP, group_id), (FACILITY, facility_id)):
+                self._incr(self.entities, parent, key, -count)
+                self._incr(self.reverse, name, parent, -count)
+
+    def remove_group(self, group_id):
+        """Removes all the resources of a resource group"""
+        for resource_id in list(self.group_resources.get(group_id, ())):
+            self.remove_resource(resource_id)
+
+    @staticmethod
+    def _incr(index, outer, inner, n):
+        """Adds n to index[outer][inner], dropping entries that reach 0"""
+        counts = index.get(outer)
+        if counts is None:
+            counts = index[outer] = collections.OrderedDict()
+        count = counts.get(inner, 0) + n
+        if count > 0:
+            counts[inner] = count
+        else:
+            counts.pop(inner, None)
+            if not counts:
+                del index[outer]
+
+    def merge(self, other):
+        """Adds everything registered in other, e.g. the registry filled by a parse_parallel worker, resource by
+        resource in the order other registered them"""
+        for resource_id, (group_id, facility_id) in other.parents.iteritems():
+            contactlists = collections.OrderedDict()
+            for (contact_type, rank, name), count in other.entities.get((RESOURCE, resource_id), {}).iteritems():
+                contacts = contactlists.setdefault(contact_type, [])
+                contacts.extend({'Name': name, 'ContactRank': rank} for _ in range(count))
+            self.add_resource(resource_id, group_id, facility_id,
+                              [{'ContactType': contact_type, 'Contacts': contacts}
+                               for contact_type, contacts in contactlists.iteritems()])
+
+    def contact_sets(self, level, entity_id):
+        """Returns the contacts of an entity as an OrderedDict {<ContactType>: OrderedDict {<ContactRank>:
+        [<Person>]}}, with the types in the order they were first seen and the ranks from Primary down"""
+        sets = collections.OrderedDict()
+        for contact_type, rank, name in self.entities.get((level, entity_id), ()):
+            sets.setdefault(contact_type, {}).setdefault(rank, []).append(self.people[name])
+        for contact_type, by_rank in sets.items():
+            sets[contact_type] = collections.OrderedDict(
+                sorted(by_rank.iteritems(), key=lambda item: (rank_order.get(item[0], len(rank_order)), item[0])))
+        return sets
+
+    def contacts(self, level, entity_id, contact_type=None, rank=None):
+        """Returns the distinct People in the contact lists of an entity, in the order they were first seen.
+        contact_type and rank, if given, restrict them to that ContactType and ContactRank"""
+        people = collections.OrderedDict()
+        for key_type, key_rank, name in self.entities.get((level, entity_id), ()):
+            if contact_type is not None and key_type != contact_type:
+                continue
+            if rank is not None and key_rank != rank:
+                continue
+            people[name] = None
+        return [self.people[name] for name in people]
+
+    def entities_of(self, name, level):
+        """Returns the IDs of the entities of level (RESOURCE, GROUP or FACILITY) that name is a contact for, in the
+        order they were first seen"""
+        return [entity_id for entity_level, entity_id in self.reverse.get(name, ()) if entity_level == level]
+
+    def resources_of(self, name):
+        return self.entities_of(name, RESOURCE)
+
+    def groups_of(self, name):
+        return self.entities_of(name, GROUP)
+
+    def facilities_of(self, name):
+        return self.entities_of(name, FACILITY)
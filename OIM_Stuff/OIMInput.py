@@ -0,0 +1,127 @@
+""" Input layer shared by the OIM topology parsers.
+
+A source is a file name (any str or unicode), a file object, or the XML itself: an XMLData wrapping a str, unicode
+string or other byte buffer, or a bytearray, memoryview, buffer or mmap (see is_data).  Whatever the source is, the
+parsers get at it in one of two ways:
+
+    open_stream(source)     a file object to read incrementally, for the DOM and pulldom parsers
+    open_buffer(source)     the whole document as one buffer, for the regex block scanners.  Files are mapped with
+                            mmap rather than read, so the pages come straight from the page cache
+
+Neither makes a full copy of the document, and both close whatever they opened themselves.  parse_document builds a
+minidom Document from a source by feeding expat from open_stream, so peak memory while loading is the DOM itself.
+"""
+
+import mmap
+import contextlib
+from xml.dom import minidom
+
+# Byte buffer types besides str that are XML data rather than a file name
+buffer_types = (bytearray, memoryview, buffer, mmap.mmap)
+
+
+class XMLData(object):
+    """The XML document itself, for passing it as a source.  data is a str or any other byte buffer, or a unicode
+    string, which is encoded as UTF-8"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.data = data
+
+
+def is_data(source):
+    """True if source is the XML itself rather than a file name or file object.  That is never guessed from the
+    contents of a string: a str or unicode source is always a file name, and XML held in one has to be wrapped in an
+    XMLData.  Byte buffers that can't be file names (bytearray, memoryview, buffer, mmap) are taken as they are"""
+    return isinstance(source, (XMLData,) + buffer_types)
+
+
+def is_path(source):
+    """True if source is a file name"""
+    return isinstance(source, basestring)
+
+
+def _data(source):
+    """Returns the byte buffer of a source that is_data"""
+    return source.data if isinstance(source, XMLData) else source
+
+
+class BufferReader(object):
+    """Read-only file object over a byte buffer.  read() hands out slices of the buffer, so it is never copied
+    whole"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.data)
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        if isinstance(chunk, memoryview):
+            return chunk.tobytes()
+        return str(chunk)
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def open_stream(source):
+    """Context manager giving a file object that reads source from the start.  A file name is opened (and closed
+    again on exit), a file object is used as it is and stays open, and XML data is read through a BufferReader"""
+    if is_data(source):
+        yield BufferReader(_data(source))
+    elif isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            yield f
+    else:
+        yield source
+
+
+def _map(f):
+    """Returns a read-only mmap of the file object f, or '' for an empty file"""
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # mmap refuses empty files
+        return ''
+
+
+@contextlib.contextmanager
+def open_buffer(source):
+    """Context manager giving the whole of source as a buffer that can be sliced, searched with find and rfind and
+    matched with regular expressions.  Files are memory-mapped, and the map is closed on exit, so slices of it must be
+    copied out (sliced) before then.  File objects that can't be mapped (pipes, downloads, StringIO) are read to the
+    end instead"""
+    if is_data(source):
+        yield _data(source)
+        return
+
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            data = _map(f)
+    else:
+        try:
+            if source.tell() != 0:
+                raise IOError("Not at the start of the file")
+            data = _map(source)
+        except (AttributeError, IOError, ValueError):
+            data = source.read()
+    try:
+        yield data
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def parse_document(source):
+    """Parses source into a minidom Document.  The parser reads the document in chunks, or straight from it if it is
+    an XMLData holding a str, so no copy of the whole document is ever made"""
+    if isinstance(source, XMLData) and isinstance(source.data, str):
+        return minidom.parseString(source.data)
+    with open_stream(source) as f:
+        return minidom.parse(f)
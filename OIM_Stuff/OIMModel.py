@@ -0,0 +1,321 @@
+""" Compact record classes for the OIM topology.
+
+OIMTopology(xml_file, compact=True) builds these instead of the plain dictionaries it builds by default.  Every record
+uses __slots__ and is a read-only mapping with the same keys as the dictionary it replaces, so code that reads
+facilities['X']['Sites'][...]['ResourceGroups'][...]['Resources'][...]['VOOwnership'] keeps working unchanged.  The
+Sites, ResourceGroups and Resources containers are still plain dictionaries.
+
+OIMTopology(xml_file, lazy=True) builds LazyResourceRecords for the resources, which only decode VOOwnership, WLCG and
+Contacts when they are first read.
+
+Records are immutable, so equal ones can be shared.  OIMTopology builds them through a RecordPool, which hands out one
+ContactRecord per contact rank, one SupportCenterRecord per support center and one record per distinct WLCG and VO
+ownership, and keeps one copy of each repeated string.
+"""
+
+import collections
+
+
+class Record(object):
+    """Base class for the read-only mapping records.  Subclasses list their (<key>, <slot>) pairs in fields.  A slot
+    that is never set (e.g. WLCG AccountingName when WLCG information is not available) is simply not a key"""
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key):
+        for field, slot in self.fields:
+            if field == key:
+                try:
+                    return getattr(self, slot)
+                except AttributeError:
+                    break
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field, slot in self.fields:
+            if hasattr(self, slot):
+                yield field
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for _, slot in self.fields if hasattr(self, slot))
+
+    def __setstate__(self, state):
+        for slot, value in state.iteritems():
+            setattr(self, slot, value)
+
+
+class FrozenMap(Record):
+    """Small read-only mapping stored as a tuple of keys and a tuple of values.  Used for the per-resource VOOwnership
+    and Contacts mappings, which only ever hold a handful of entries"""
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, items=()):
+        items = tuple(items)
+        self._keys = tuple(key for key, _ in items)
+        self._values = tuple(value for _, value in items)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getstate__(self):
+        return {'_keys': self._keys, '_values': self._values}
+
+
+class FacilityRecord(Record):
+    """Compact form of the facility dictionary {'Name': <name>, 'ID': <ID>, 'Sites': <sites dictionary>}"""
+    __slots__ = ('name', 'id', 'sites')
+    fields = (('Name', 'name'), ('ID', 'id'), ('Sites', 'sites'))
+
+    def __init__(self, name, id, sites):
+        self.name = name
+        self.id = id
+        self.sites = sites
+
+
+class SupportCenterRecord(Record):
+    """Compact form of the support center dictionary {'Name':<name>, 'ID':<ID>}"""
+    __slots__ = ('name', 'id')
+    fields = (('Name', 'name'), ('ID', 'id'))
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+
+class SiteRecord(Record):
+    """Compact form of the site dictionary {'Name':<name>, 'ID': <id>, 'SupportCenter': {<support center>},
+    'ResourceGroups': {<Resource Groups Dictionary>}}"""
+    __slots__ = ('name', 'id', 'supportcenter', 'resourcegroups')
+    fields = (('Name', 'name'), ('ID', 'id'), ('SupportCenter', 'supportcenter'),
+              ('ResourceGroups', 'resourcegroups'))
+
+    def __init__(self, name, id, supportcenter, resourcegroups):
+        self.name = name
+        self.id = id
+        self.supportcenter = supportcenter
+        self.resourcegroups = resourcegroups
+
+
+class ResourceGroupRecord(Record):
+    """Compact form of the resource group dictionary {'Name':<name>, 'ID':<id>, 'Resources': {<Resources>}}"""
+    __slots__ = ('name', 'id', 'resources')
+    fields = (('Name', 'name'), ('ID', 'id'), ('Resources', 'resources'))
+
+    def __init__(self, name, id, resources):
+        self.name = name
+        self.id = id
+        self.resources = resources
+
+
+class WLCGRecord(Record):
+    """Compact form of the WLCG dictionary {'Available': <True/False>, 'AccountingName':<accountingname>}"""
+    __slots__ = ('available', 'accountingname')
+    fields = (('Available', 'available'), ('AccountingName', 'accountingname'))
+
+    def __init__(self, wlcg):
+        self.available = wlcg['Available']
+        if 'AccountingName' in wlcg:
+            self.accountingname = wlcg['AccountingName']
+
+
+class ContactRecord(Record):
+    """Compact form of a contact dictionary {'Email': <None for now>, 'ContactRank': <rank>}"""
+    __slots__ = ('email', 'rank')
+    fields = (('Email', 'email'), ('ContactRank', 'rank'))
+
+    def __init__(self, email, rank):
+        self.email = email
+        self.rank = rank
+
+
+class ResourceRecord(Record):
+    """Compact form of the resource dictionary {'Name': <name>, 'ID': <id>, 'FQDN': <fqdn>, 'VOOwnership': {<vo
+    ownership>}, 'WLCG': {<WLCG>}, 'Contacts': {<Contacts>}}.  VOOwnership, WLCG and Contacts that are None (left out
+    by a projection) are not keys"""
+    __slots__ = ('name', 'id', 'fqdn', 'vo_ownership', 'wlcg', 'contacts')
+    fields = (('Name', 'name'), ('ID', 'id'), ('FQDN', 'fqdn'), ('VOOwnership', 'vo_ownership'), ('WLCG', 'wlcg'),
+              ('Contacts', 'contacts'))
+
+    def __init__(self, name, id, fqdn, vo_ownership=None, wlcg=None, contacts=None):
+        self.name = name
+        self.id = id
+        self.fqdn = fqdn
+        if vo_ownership is not None:
+            self.vo_ownership = vo_ownership
+        if wlcg is not None:
+            self.wlcg = wlcg
+        if contacts is not None:
+            self.contacts = contacts
+
+
+class LazyResourceRecord(Record):
+    """Resource record built by OIMTopology(xml_file, lazy=True).  Name, ID and FQDN are set at parse time, and the
+    details (the keys of VOOwnership, WLCG and Contacts that a projection keeps, by default all three) are decoded by
+    calling decoder(*source) the first time any of them is read, and kept from then on.  The decoder returns the
+    (VOOwnership, WLCG, Contacts) of the resource, with None for the ones that are not details"""
+    __slots__ = ('name', 'id', 'fqdn', 'vo_ownership', 'wlcg', 'contacts', 'decoder', 'source', 'details')
+    fields = ResourceRecord.fields
+    lazy_slots = ('vo_ownership', 'wlcg', 'contacts')
+
+    def __init__(self, name, id, fqdn, decoder, source, details=('VOOwnership', 'WLCG', 'Contacts')):
+        self.name = name
+        self.id = id
+        self.fqdn = fqdn
+        self.decoder = decoder
+        self.source = source
+        self.details = details
+
+    @property
+    def loaded(self):
+        """True once the lazy fields have been decoded"""
+        return hasattr(self, 'contacts')
+
+    def load(self):
+        """Decodes the lazy fields now"""
+        self.vo_ownership, self.wlcg, self.contacts = self.decoder(*self.source)
+
+    def __getitem__(self, key):
+        for field, slot in self.fields:
+            if field == key:
+                if slot in self.lazy_slots:
+                    if field not in self.details:
+                        break
+                    if not self.loaded:
+                        self.load()
+                return getattr(self, slot)
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field, slot in self.fields:
+            if slot not in self.lazy_slots or field in self.details:
+                yield field
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__ if hasattr(self, slot))
+
+
+class RecordFactory(object):
+    """Builds the records that can be shared between resources and sites.  This one builds a new record every time;
+    RecordPool shares them"""
+    def intern(self, value):
+        return value
+
+    def contact(self, email, rank):
+        return ContactRecord(email, rank)
+
+    def support_center(self, name, id):
+        return SupportCenterRecord(name, id)
+
+    def wlcg(self, wlcg):
+        return WLCGRecord(wlcg)
+
+    def vo_ownership(self, items):
+        return FrozenMap(items)
+
+
+class RecordPool(RecordFactory):
+    """RecordFactory that hands out one shared (flyweight) record for equal arguments, and interns strings.  Python 2's
+    intern() only takes str, so strings are interned in a dictionary of their own, keyed by type as well as value so
+    a str never comes back as an equal unicode or the other way round"""
+    def __init__(self):
+        self.strings = {}
+        self.records = {}
+
+    def intern(self, value):
+        try:
+            return self.strings.setdefault((type(value), value), value)
+        except TypeError:
+            return value
+
+    def contact(self, email, rank):
+        key = ('contact', email, rank)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = ContactRecord(email, rank)
+        return record
+
+    def support_center(self, name, id):
+        key = ('support_center', name, id)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = SupportCenterRecord(self.intern(name), self.intern(id))
+        return record
+
+    def wlcg(self, wlcg):
+        key = ('wlcg', wlcg['Available'], 'AccountingName' in wlcg, wlcg.get('AccountingName'))
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = WLCGRecord(wlcg)
+        return record
+
+    def vo_ownership(self, items):
+        items = tuple(items)
+        key = ('vo_ownership', frozenset(items))
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = FrozenMap(items)
+        return record
+
+
+collections.Mapping.register(Record)
@@ -0,0 +1,260 @@
+""" Index for resolving Gratia HostDescription strings to OIM facilities and resource groups.
+
+Gratia host descriptions are set up by site admins and may be a resource group name, a resource name, the FQDN of the
+CE, or part of any of those.  The matching rules are the ones OIMTopology.get_facility_by_resource has always used:
+walking the resource groups in order, a group matches if
+
+    - its name equals the host (case-insensitive), or
+    - the host (lowercased) is a substring of one of its FQDNs, or
+    - the host (lowercased) is a substring of one of its lowercased resource names
+
+and the first matching group wins.  HostResolver gives the same answers from indexes built once after parse.
+"""
+
+import copy
+import multiprocessing
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class HostResolver(object):
+    """Inverted indexes over the resource groups of a topology.  Every group gets a sequence number in matching
+    order, and every index maps a key to the sorted sequence numbers of the groups it matches, so a lookup is the
+    smallest sequence number found in any index"""
+    ngram = 3
+    max_memo = 100000
+
+    def __init__(self):
+        self.entries = []               # [(<facility>, <resource group>)], indexed by sequence number
+        self.ids = []                   # [(<facility id>, <group id>, [(<lowercase resource name>, <fqdn>,
+                                        #   <resource id>)])], indexed by sequence number
+        self.facility_ranges = {}       # {<facility key>: [<first seq>, <last seq + 1>]}
+        self.group_names = {}           # {<lowercase group name>: [<seqs>]}
+        self.resource_names = {}        # {<lowercase resource name>: [<seqs>]}
+        self.fqdns = {}                 # {<fqdn>: [<seqs>]}
+        self.domains = {}               # reversed-label trie {<label>: ({<label>: ...}, [<seqs>])}
+        self.strings = []               # [(<fqdn or lowercase resource name>, <seq>)], searched by substring
+        self.grams = {}                 # {<ngram>: set(<index into self.strings>)}
+        self.memo = {}
+
+    @classmethod
+    def from_facilities(cls, facilities):
+        """Builds the resolver from a {<name>: Facility} dictionary as returned by OIMTopology.parse(), in the same
+        order get_facility_by_resource walks it"""
+        resolver = cls()
+        for name, facility in facilities.items():
+            for resource_group in facility.resource_groups:
+                resources = [(resource.name, resource.fqdns, resource.rid) for resource in resource_group.resources]
+                resolver.add_group(name, name, facility, resource_group.name, resource_group, resource_group.name,
+                                   resource_group.fqdns, resources)
+        return resolver
+
+    @classmethod
+    def from_facility_dicts(cls, facilities):
+        """Builds the resolver from the facilities dictionary built by OIMTopology.OIMTopology.parse().  Facilities,
+        resource groups and resources are identified by their OIM IDs, and the FQDNs of a group are the FQDNs of its
+        resources"""
+        resolver = cls()
+        for name, facility in facilities.items():
+            for site in facility['Sites'].values():
+                for resource_group in site['ResourceGroups'].values():
+                    resources = [(resource['Name'], resource['FQDN'], resource['ID'])
+                                 for resource in resource_group['Resources'].values()]
+                    resolver.add_group(name, facility['ID'], facility, resource_group['ID'], resource_group,
+                                       resource_group['Name'], [fqdn for _, fqdn, _ in resources], resources)
+        return resolver
+
+    def add_group(self, facility_key, facility_id, facility, group_id, group, group_name, fqdns, resources):
+        """Adds a resource group to the indexes.  resources is a list of (<name>, <fqdn>, <id>) tuples.  Groups of the
+        same facility must be added one after the other"""
+        seq = len(self.entries)
+        self.entries.append((facility, group))
+        self.ids.append((facility_id, group_id,
+                         [(resource_name.lower(), fqdn, resource_id) for resource_name, fqdn, resource_id in resources]))
+        if facility_key in self.facility_ranges:
+            self.facility_ranges[facility_key][1] = seq + 1
+        else:
+            self.facility_ranges[facility_key] = [seq, seq + 1]
+
+        self._add(self.group_names, group_name.lower(), seq)
+        for fqdn in fqdns:
+            self._add(self.fqdns, fqdn, seq)
+            self._add_domain(fqdn, seq)
+            self._add_string(fqdn, seq)
+        for resource_name, _, _ in resources:
+            self._add(self.resource_names, resource_name.lower(), seq)
+            self._add_string(resource_name.lower(), seq)
+        self.memo = {}
+
+    @classmethod
+    def _add(cls, index, key, seq):
+        """Appends seq to the posting list of key in index"""
+        cls._add_seq(index.setdefault(key, []), seq)
+
+    def _add_domain(self, fqdn, seq):
+        """Adds fqdn to the domain-suffix trie, so every label-aligned suffix of it maps to seq"""
+        node = (self.domains, None)
+        for label in reversed(fqdn.split('.')):
+            if label not in node[0]:
+                node[0][label] = ({}, [])
+            node = node[0][label]
+            self._add_seq(node[1], seq)
+
+    @staticmethod
+    def _add_seq(seqs, seq):
+        """Appends seq to a posting list.  Groups are added in sequence order, so the list stays sorted"""
+        if not seqs or seqs[-1] != seq:
+            seqs.append(seq)
+
+    def _add_string(self, text, seq):
+        """Adds text to the substring index"""
+        index = len(self.strings)
+        self.strings.append((text, seq))
+        for i in xrange(len(text) - self.ngram + 1):
+            self.grams.setdefault(text[i:i + self.ngram], set()).add(index)
+
+    def resolve(self, host, facility_key=None):
+        """Returns the (facility, resource group) of the first group that matches host, or None if nothing matches.
+        If facility_key is given, only the groups of that facility are considered"""
+        seq = self.find(host, facility_key)
+        if seq is None:
+            return None
+        return self.entries[seq]
+
+    def resolve_ids(self, host):
+        """Returns the (facility id, resource group id, resource id) that host resolves to.  The resource is the first
+        one in the matching group whose name or FQDN contains host, or the group's first resource if only the group
+        name matched.  Anything that can't be resolved is None"""
+        seq = self.find(host)
+        if seq is None:
+            return None, None, None
+        facility_id, group_id, resources = self.ids[seq]
+        name = host.lower()
+        for resource_name, fqdn, resource_id in resources:
+            if name in resource_name or name in fqdn:
+                return facility_id, group_id, resource_id
+        if resources:
+            return facility_id, group_id, resources[0][2]
+        return facility_id, group_id, None
+
+    def resolve_many(self, hosts, processes=None, chunksize=1000):
+        """Resolves a batch of host strings, e.g. the HostDescription of every Gratia accounting record in a month.
+        Each distinct host is only resolved once.  If processes is more than 1, the distinct hosts are split across a
+        process pool of that size.  Returns (facility ids, resource group ids, resource ids) aligned with hosts, as
+        numpy object arrays if hosts is a numpy array and as lists otherwise"""
+        if numpy is not None and isinstance(hosts, numpy.ndarray):
+            unique, codes = numpy.unique(hosts, return_inverse=True)
+        else:
+            positions = {}
+            codes = []
+            for host in hosts:
+                code = positions.get(host)
+                if code is None:
+                    code = positions[host] = len(positions)
+                codes.append(code)
+            unique = [None] * len(positions)
+            for host, code in positions.iteritems():
+                unique[code] = host
+
+        if processes is not None and processes > 1 and len(unique) > chunksize:
+            # Workers only need the indexes, not the facility and group objects
+            worker = copy.copy(self)
+            worker.entries = None
+            worker.memo = {}
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(worker,))
+            try:
+                results = pool.map(_resolve_ids, unique, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.resolve_ids(host) for host in unique]
+
+        columns = zip(*results) or [(), (), ()]
+        if numpy is not None and isinstance(hosts, numpy.ndarray):
+            return tuple(numpy.array(column, dtype=object)[codes] for column in columns)
+        return tuple([column[code] for code in codes] for column in columns)
+
+    def find(self, host, facility_key=None):
+        """Returns the sequence number of the first group that matches host, or None if nothing matches.  If
+        facility_key is given, only the groups of that facility are considered"""
+        memo_key = (host, facility_key)
+        try:
+            return self.memo[memo_key]
+        except KeyError:
+            pass
+
+        if facility_key is None:
+            lo, hi = 0, len(self.ids)
+        elif facility_key in self.facility_ranges:
+            lo, hi = self.facility_ranges[facility_key]
+        else:
+            return None
+
+        name = host.lower()
+        best = hi
+
+        # Exact matches are cheap and give an upper bound for the substring search
+        for index in (self.group_names, self.resource_names, self.fqdns):
+            best = self._first(index.get(name), lo, best)
+        node = (self.domains, None)
+        for label in reversed(name.split('.')):
+            node = node[0].get(label)
+            if node is None:
+                break
+        else:
+            best = self._first(node[1], lo, best)
+
+        # Anything else is a partial match on an FQDN or a resource name (e.g. BNL_ATLAS vs BNL_ATLAS_1).  Only
+        # strings that belong to a group ahead of the best match so far need checking.
+        for text, seq in self._substring_candidates(name):
+            if lo <= seq < best and name in text:
+                best = seq
+
+        result = best if best < hi else None
+        if len(self.memo) >= self.max_memo:
+            self.memo = {}
+        self.memo[memo_key] = result
+        return result
+
+    @staticmethod
+    def _first(seqs, lo, best):
+        """Returns the smallest seq in the sorted list seqs that is >= lo, if it is smaller than best"""
+        if not seqs:
+            return best
+        i = bisect_left(seqs, lo)
+        if i < len(seqs) and seqs[i] < best:
+            return seqs[i]
+        return best
+
+    def _substring_candidates(self, name):
+        """Returns the (text, seq) entries of the substring index that could contain name"""
+        if len(name) < self.ngram:
+            return self.strings
+        postings = sorted((self.grams.get(name[i:i + self.ngram], ()) for i in xrange(len(name) - self.ngram + 1)),
+                          key=len)
+        if not postings[0]:
+            return ()
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return ()
+        return [self.strings[index] for index in candidates]
+
+
+# Resolver used by the process pool workers of HostResolver.resolve_many
+_worker_resolver = None
+
+
+def _init_worker(resolver):
+    global _worker_resolver
+    _worker_resolver = resolver
+
+
+def _resolve_ids(host):
+    return _worker_resolver.resolve_ids(host)
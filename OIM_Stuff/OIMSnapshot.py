@@ -0,0 +1,373 @@
+""" Flat binary snapshot of an OIM topology, for sharing between processes.
+
+write_snapshot writes the facilities dictionary built by OIMTopology.OIMTopology.parse() into one file of fixed-width
+record tables (facilities, sites, resource groups, resources), a string heap holding every distinct string once, and
+precomputed open-addressing hash tables for the lookups.  TopologySnapshot opens the file with mmap and answers queries
+by reading the few records and strings they touch, without deserializing anything, so opening takes no time however
+big the topology is, and any number of worker processes share one copy of the pages through the page cache, e.g.
+
+    write_snapshot(topology.facilities, 'topology.snap')
+    ...
+    snapshot = TopologySnapshot('topology.snap')            # in each worker
+    snapshot.resource_by_fqdn('gridgk01.racf.bnl.gov').facility
+    snapshot.resolve_ids('BNL_ATLAS')
+
+resolve_ids follows the matching rules of OIMResolver.HostResolver, with the resource groups in the order
+HostResolver.from_facility_dicts adds them, so it gives the same answers (with the OIM IDs as ints).  All numbers are
+little-endian, and a snapshot can only be read by code with the SNAPSHOT_VERSION that wrote it.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import tempfile
+import collections
+
+MAGIC = 'OIMSNAP\0'
+SNAPSHOT_VERSION = 1
+
+# Sections of the file, in the order of their (<offset>, <count>) pairs in the header.  The count of the heap and
+# search sections is their size in bytes, and that of the others their number of entries
+SECTIONS = ('heap', 'facilities', 'sites', 'groups', 'resources', 'search', 'search_index', 'facility_names',
+            'group_names', 'resource_names', 'fqdns', 'resource_ids')
+HEADER = struct.Struct('<8sI' + 'QQ' * len(SECTIONS))
+
+# Strings are (<heap offset>, <length>) pairs, of UTF-8
+FACILITY = struct.Struct('<iII')            # ID, name
+SITE = struct.Struct('<iIIIiII')            # ID, name, facility index, support center ID, support center name
+GROUP = struct.Struct('<iIIIII')            # ID, name, site index, index of its first resource, number of resources
+RESOURCE = struct.Struct('<iIIIII')         # ID, name, FQDN, group index
+SEARCH_ENTRY = struct.Struct('<II')         # offset of a group's first line in the search section, group index
+SLOT = struct.Struct('<II')                 # hash of the key, record index + 1 (0 for an empty slot)
+
+SnapshotFacility = collections.namedtuple('SnapshotFacility', ['id', 'name'])
+SnapshotGroup = collections.namedtuple('SnapshotGroup', [
+    'id', 'name', 'site_id', 'site', 'facility_id', 'facility', 'support_center_id', 'support_center'])
+SnapshotResource = collections.namedtuple('SnapshotResource', [
+    'id', 'name', 'fqdn', 'group_id', 'group', 'site_id', 'site', 'facility_id', 'facility', 'support_center_id',
+    'support_center'])
+
+
+def _hash(key):
+    """Hash of a str key that is the same in every process, unlike hash() when hash randomization is on"""
+    return zlib.crc32(key) & 0xffffffff
+
+
+def _encode(text):
+    """Returns text as a UTF-8 str"""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _key(text):
+    """Returns the lookup key of a name or FQDN, which are matched case-insensitively"""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return text.lower().encode('utf-8')
+
+
+def _int(value):
+    """Returns an OIM ID as an int, or -1 if there is none"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+class _SnapshotWriter(object):
+    """Builds the sections of a snapshot in memory.  Every section is a list of str pieces"""
+    def __init__(self):
+        self.strings = {}               # {<UTF-8 str>: (<heap offset>, <length>)}
+        self.heap_size = 0
+        self.search_size = 0
+        self.sections = dict((name, []) for name in SECTIONS)
+        self.keys = dict((name, []) for name in ('facility_names', 'group_names', 'resource_names', 'fqdns',
+                                                 'resource_ids'))
+
+    def string(self, text):
+        """Adds text to the heap unless it is already there, and returns its (<offset>, <length>)"""
+        data = _encode(text) if text is not None else ''
+        try:
+            return self.strings[data]
+        except KeyError:
+            ref = self.strings[data] = (self.heap_size, len(data))
+            self.sections['heap'].append(data)
+            self.heap_size += len(data)
+            return ref
+
+    def add_facilities(self, facilities):
+        """Adds the facilities, sites, resource groups and resources of a facilities dictionary, walking it in the
+        order HostResolver.from_facility_dicts does"""
+        sections = self.sections
+        for facility in facilities.values():
+            facility_index = len(sections['facilities'])
+            sections['facilities'].append(FACILITY.pack(_int(facility['ID']), *self.string(facility['Name'])))
+            self.keys['facility_names'].append(_key(facility['Name']))
+
+            for site in facility['Sites'].values():
+                site_index = len(sections['sites'])
+                supportcenter = site['SupportCenter']
+                sections['sites'].append(SITE.pack(_int(site['ID']), *(
+                    self.string(site['Name']) + (facility_index, _int(supportcenter['ID'])) +
+                    self.string(supportcenter['Name']))))
+
+                for group in site['ResourceGroups'].values():
+                    group_index = len(sections['groups'])
+                    resources = group['Resources'].values()
+                    sections['groups'].append(GROUP.pack(_int(group['ID']), *(
+                        self.string(group['Name']) + (site_index, len(sections['resources']), len(resources)))))
+                    self.keys['group_names'].append(_key(group['Name']))
+
+                    # HostResolver's substring search is over the FQDNs and the lowercased names of the resources,
+                    # which go into the search section one per line, group after group
+                    if resources:
+                        sections['search_index'].append(SEARCH_ENTRY.pack(self.search_size, group_index))
+                    for resource in resources:
+                        sections['resources'].append(RESOURCE.pack(_int(resource['ID']), *(
+                            self.string(resource['Name']) + self.string(resource['FQDN']) + (group_index,))))
+                        self.keys['resource_names'].append(_key(resource['Name']))
+                        self.keys['fqdns'].append(_key(resource['FQDN']))
+                        self.keys['resource_ids'].append(str(_int(resource['ID'])))
+                        for text in (resource['FQDN'], resource['Name'].lower()):
+                            line = _encode(text) + '\n'
+                            sections['search'].append(line)
+                            self.search_size += len(line)
+
+    @staticmethod
+    def hash_table(keys):
+        """Returns the slots of an open-addressing (linear probing) hash table of the str keys, mapping each to its
+        index in keys.  Equal keys are probed in index order, so the first of them is found first"""
+        size = 1
+        while size < 2 * len(keys):
+            size *= 2
+        hashes = [0] * size
+        indexes = [0] * size
+        for index, key in enumerate(keys):
+            h = _hash(key)
+            i = h & (size - 1)
+            while indexes[i]:
+                i = (i + 1) & (size - 1)
+            hashes[i] = h
+            indexes[i] = index + 1
+        return [SLOT.pack(h, index) for h, index in zip(hashes, indexes)]
+
+    def write(self, f):
+        """Writes the snapshot to the file object f"""
+        for name, keys in self.keys.iteritems():
+            self.sections[name] = self.hash_table(keys)
+
+        offsets = []
+        offset = HEADER.size
+        for name in SECTIONS:
+            size = sum(len(piece) for piece in self.sections[name])
+            offsets.extend((offset, size if name in ('heap', 'search') else len(self.sections[name])))
+            offset += size
+        f.write(HEADER.pack(MAGIC, SNAPSHOT_VERSION, *offsets))
+        for name in SECTIONS:
+            f.write(''.join(self.sections[name]))
+
+
+def write_snapshot(facilities, path):
+    """Writes a snapshot of the facilities dictionary (or compact records) built by OIMTopology.OIMTopology.parse() to
+    path.  It is written to a temp file and renamed, so readers never see a partial snapshot"""
+    writer = _SnapshotWriter()
+    writer.add_facilities(facilities)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer.write(f)
+        os.rename(tmppath, path)
+    except Exception:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+class TopologySnapshot(object):
+    """Read-only view of a snapshot file, mapped into memory.  Lookups of names and FQDNs are case-insensitive, and
+    return SnapshotFacility, SnapshotGroup and SnapshotResource tuples decoded from the records they touch"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self.mm, 0)
+        if fields[0] != MAGIC or fields[1] != SNAPSHOT_VERSION:
+            self.mm.close()
+            raise ValueError("{0} is not a version {1} topology snapshot".format(path, SNAPSHOT_VERSION))
+        self.sections = dict(zip(SECTIONS, zip(fields[2::2], fields[3::2])))
+        self.heap_offset = self.sections['heap'][0]
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def count(self, section):
+        """Returns the number of facilities, sites, groups or resources in the snapshot"""
+        return self.sections[section][1]
+
+    def _record(self, section, record, index):
+        return record.unpack_from(self.mm, self.sections[section][0] + index * record.size)
+
+    def _string(self, offset, length):
+        start = self.heap_offset + offset
+        return self.mm[start:start + length].decode('utf-8')
+
+    def facility(self, index):
+        """Returns the facility with the index passed in"""
+        id, name_offset, name_length = self._record('facilities', FACILITY, index)
+        return SnapshotFacility(id, self._string(name_offset, name_length))
+
+    def group(self, index):
+        """Returns the resource group with the index passed in"""
+        id, name_offset, name_length, site_index, _, _ = self._record('groups', GROUP, index)
+        site_id, site_offset, site_length, facility_index, supportcenter_id, supportcenter_offset, \
+            supportcenter_length = self._record('sites', SITE, site_index)
+        facility = self.facility(facility_index)
+        return SnapshotGroup(id, self._string(name_offset, name_length), site_id,
+                             self._string(site_offset, site_length), facility.id, facility.name, supportcenter_id,
+                             self._string(supportcenter_offset, supportcenter_length))
+
+    def resource(self, index):
+        """Returns the resource with the index passed in"""
+        id, name_offset, name_length, fqdn_offset, fqdn_length, group_index = self._record('resources', RESOURCE,
+                                                                                            index)
+        return SnapshotResource(id, self._string(name_offset, name_length), self._string(fqdn_offset, fqdn_length),
+                                *self.group(group_index))
+
+    def _find(self, table, key, key_of):
+        """Generator that yields the index of every record whose key (as returned by key_of(<index>)) is key, in
+        record order, by probing the hash table table"""
+        offset, size = self.sections[table]
+        if not size:
+            return
+        h = _hash(key)
+        i = h & (size - 1)
+        while True:
+            slot_hash, index = SLOT.unpack_from(self.mm, offset + i * SLOT.size)
+            if not index:
+                return
+            if slot_hash == h and key_of(index - 1) == key:
+                yield index - 1
+            i = (i + 1) & (size - 1)
+
+    def _first(self, table, key, key_of):
+        for index in self._find(table, key, key_of):
+            return index
+        return None
+
+    def _facility_key(self, index):
+        return _key(self._string(*self._record('facilities', FACILITY, index)[1:3]))
+
+    def _group_key(self, index):
+        return _key(self._string(*self._record('groups', GROUP, index)[1:3]))
+
+    def _resource_name_key(self, index):
+        return _key(self._string(*self._record('resources', RESOURCE, index)[1:3]))
+
+    def _fqdn_key(self, index):
+        return _key(self._string(*self._record('resources', RESOURCE, index)[3:5]))
+
+    def _resource_id_key(self, index):
+        return str(self._record('resources', RESOURCE, index)[0])
+
+    def facility_named(self, name):
+        """Returns the first facility called name, or None"""
+        index = self._first('facility_names', _key(name), self._facility_key)
+        return self.facility(index) if index is not None else None
+
+    def group_named(self, name):
+        """Returns the first resource group called name, or None"""
+        index = self._first('group_names', _key(name), self._group_key)
+        return self.group(index) if index is not None else None
+
+    def resources_named(self, name):
+        """Returns every resource called name"""
+        return [self.resource(index) for index in self._find('resource_names', _key(name), self._resource_name_key)]
+
+    def resource_by_fqdn(self, fqdn):
+        """Returns the first resource with the FQDN fqdn, or None"""
+        index = self._first('fqdns', _key(fqdn), self._fqdn_key)
+        return self.resource(index) if index is not None else None
+
+    def resource_by_id(self, resource_id):
+        """Returns the first resource with the OIM ID resource_id, or None"""
+        index = self._first('resource_ids', str(_int(resource_id)), self._resource_id_key)
+        return self.resource(index) if index is not None else None
+
+    def find(self, host):
+        """Returns the index of the first resource group that matches host by HostResolver's rules, or None.  The
+        substring search is a single mmap.find over the search section, whose lines are in group order"""
+        name = host.lower()
+        best = self._first('group_names', _key(name), self._group_key)
+
+        key = _encode(name)
+        offset, size = self.sections['search']
+        if '\n' not in key:
+            end = offset + size
+            if best is not None:
+                # Only groups ahead of the group name match can do better
+                end = offset + self._search_start(best)
+            position = self.mm.find(key, offset, end) if end > offset else -1
+            if position >= 0:
+                best = self._search_group(position - offset)
+        return best
+
+    def _search_start(self, group_index):
+        """Returns the offset in the search section of the lines of the first group from group_index on that has
+        any"""
+        offset, count = self.sections['search_index']
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if SEARCH_ENTRY.unpack_from(self.mm, offset + mid * SEARCH_ENTRY.size)[1] < group_index:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == count:
+            return self.sections['search'][1]
+        return SEARCH_ENTRY.unpack_from(self.mm, offset + lo * SEARCH_ENTRY.size)[0]
+
+    def _search_group(self, position):
+        """Returns the index of the group whose lines hold the byte at position in the search section"""
+        offset, count = self.sections['search_index']
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if SEARCH_ENTRY.unpack_from(self.mm, offset + mid * SEARCH_ENTRY.size)[0] <= position:
+                lo = mid + 1
+            else:
+                hi = mid
+        return SEARCH_ENTRY.unpack_from(self.mm, offset + (lo - 1) * SEARCH_ENTRY.size)[1]
+
+    def resolve(self, host):
+        """Returns the first resource group that matches host, or None"""
+        index = self.find(host)
+        return self.group(index) if index is not None else None
+
+    def resolve_ids(self, host):
+        """Returns the (facility id, resource group id, resource id) that host resolves to, as
+        HostResolver.resolve_ids does.  Anything that can't be resolved is None"""
+        index = self.find(host)
+        if index is None:
+            return None, None, None
+        group_id, _, _, site_index, first, nresources = self._record('groups', GROUP, index)
+        facility_id = self.facility(self._record('sites', SITE, site_index)[3]).id
+        name = host.lower()
+        for resource_index in xrange(first, first + nresources):
+            resource_id, name_offset, name_length, fqdn_offset, fqdn_length, _ = self._record('resources', RESOURCE,
+                                                                                               resource_index)
+            if name in self._string(name_offset, name_length).lower() or name in self._string(fqdn_offset,
+                                                                                               fqdn_length):
+                return facility_id, group_id, resource_id
+        if nresources:
+            return facility_id, group_id, self._record('resources', RESOURCE, first)[0]
+        return facility_id, group_id, None
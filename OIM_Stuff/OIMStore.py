@@ -0,0 +1,344 @@
+""" SQLite store of an OIM topology.
+
+TopologyStore writes the facilities, sites, support centers, resource groups and resources of an OIM XML file into a
+normalized SQLite database, along with each resource's services, VO ownership and contacts, and answers lookups such as
+"which facility owns this FQDN" or "which resources have this WLCG AccountingName" straight from its indexes.  The XML
+is only read when the database is (re)loaded, e.g.
+
+    store = open_store('resource_group_TEST.xml', 'topology.db')    # Parses the XML only if it changed
+    store.resource_by_fqdn('gate01.aglt2.org')['facility']
+    store.resources_by_accounting_name('US-AGLT2')
+
+The resources are the ones OIMTopology keeps (by default the enabled CEs and Connect resources), all contact lists are
+stored whatever their ContactType, each person in them is stored once and linked to the resources they are a contact
+for, and names and FQDNs are matched case-insensitively.
+"""
+
+import sqlite3
+import hashlib
+import itertools
+import collections
+
+from OIMTopology import OIMTopology, PARSER_VERSION
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS facilities (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS support_centers (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sites (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    facility_id INTEGER NOT NULL REFERENCES facilities (id),
+    support_center_id INTEGER REFERENCES support_centers (id)
+);
+CREATE TABLE IF NOT EXISTS resource_groups (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    grid_type TEXT,
+    site_id INTEGER NOT NULL REFERENCES sites (id)
+);
+CREATE TABLE IF NOT EXISTS resources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    fqdn TEXT,
+    group_id INTEGER NOT NULL REFERENCES resource_groups (id),
+    active INTEGER,
+    disabled INTEGER,
+    wlcg_available INTEGER,
+    accounting_name TEXT
+);
+CREATE TABLE IF NOT EXISTS services (
+    resource_id INTEGER NOT NULL REFERENCES resources (id),
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vo_ownership (
+    resource_id INTEGER NOT NULL REFERENCES resources (id),
+    vo TEXT NOT NULL,
+    percent REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS persons (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    email TEXT
+);
+CREATE TABLE IF NOT EXISTS resource_persons (
+    resource_id INTEGER NOT NULL REFERENCES resources (id),
+    person_id INTEGER NOT NULL REFERENCES persons (id),
+    contact_type TEXT NOT NULL,
+    rank TEXT
+);
+CREATE INDEX IF NOT EXISTS facilities_name ON facilities (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS support_centers_name ON support_centers (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS sites_name ON sites (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS sites_facility ON sites (facility_id);
+CREATE INDEX IF NOT EXISTS resource_groups_name ON resource_groups (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS resource_groups_site ON resource_groups (site_id);
+CREATE INDEX IF NOT EXISTS resources_name ON resources (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS resources_fqdn ON resources (fqdn COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS resources_group ON resources (group_id);
+CREATE INDEX IF NOT EXISTS resources_accounting_name ON resources (accounting_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS services_resource ON services (resource_id);
+CREATE INDEX IF NOT EXISTS services_name ON services (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS vo_ownership_resource ON vo_ownership (resource_id);
+CREATE INDEX IF NOT EXISTS vo_ownership_vo ON vo_ownership (vo COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS persons_name ON persons (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS resource_persons_resource ON resource_persons (resource_id);
+CREATE INDEX IF NOT EXISTS resource_persons_person ON resource_persons (person_id);
+"""
+
+# Scripts bringing a store up to each schema version from the one before.  A store without a schema_version is
+# version 1
+MIGRATIONS = {
+    # Contacts were stored per resource, names and all, before schema version 2
+    2: "DROP TABLE IF EXISTS contacts;",
+}
+
+# Tables emptied by a reload, children first
+DATA_TABLES = ['resource_persons', 'persons', 'vo_ownership', 'services', 'resources', 'resource_groups', 'sites',
+               'support_centers', 'facilities']
+
+# A resource with the names of everything above it
+RESOURCE_QUERY = """
+SELECT r.id AS id, r.name AS name, r.fqdn AS fqdn, r.active AS active, r.disabled AS disabled,
+       r.wlcg_available AS wlcg_available, r.accounting_name AS accounting_name,
+       g.id AS group_id, g.name AS resource_group, g.grid_type AS grid_type,
+       s.id AS site_id, s.name AS site, f.id AS facility_id, f.name AS facility,
+       c.id AS support_center_id, c.name AS support_center
+FROM resources r
+JOIN resource_groups g ON g.id = r.group_id
+JOIN sites s ON s.id = g.site_id
+JOIN facilities f ON f.id = s.facility_id
+LEFT JOIN support_centers c ON c.id = s.support_center_id
+"""
+
+
+def _flag(text):
+    """Returns the text of an Active or Disable element as a bool, or None if there was no such element"""
+    return None if text is None else text == 'True'
+
+
+class TopologyStore(object):
+    """SQLite database holding one OIM topology.  Lookups return dictionaries keyed by column name, or lists of them,
+    in OIM ID order"""
+    chunk_size = 1024 * 1024
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def migrate(self):
+        """Runs the MIGRATIONS newer than the schema_version stored in meta, once each, and stores SCHEMA_VERSION"""
+        version = int(self.get_meta('schema_version') or 1)
+        if version >= SCHEMA_VERSION:
+            return
+        with self.conn:
+            for step in range(version + 1, SCHEMA_VERSION + 1):
+                if step in MIGRATIONS:
+                    self.conn.execute(MIGRATIONS[step])
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('schema_version', str(SCHEMA_VERSION)))
+
+    def source_key(self, xml_file, topology=None):
+        """Returns the key of xml_file's contents, the parser and the store schema, plus the topology options that
+        change what is stored.  The store is only reloaded when it changes"""
+        h = hashlib.sha1()
+        options = topology.cache_options() if topology is not None else None
+        h.update('{0}:{1}:{2!r}:'.format(PARSER_VERSION, SCHEMA_VERSION, options))
+        with open(xml_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def load(self, topology, source=None, source_key=None):
+        """Replaces the contents of the store with the resources topology keeps from its XML file (or source, a file
+        name or file object).  The file is streamed with OIMTopology.iter_resource_records, so topology.facilities is
+        neither needed nor touched.  The whole file is read and checked before anything is written: a resource group
+        or resource missing an element the store needs raises OIMTopology.MissingElementError, naming it, and leaves
+        the store as it was.  Everything is then written in a single transaction, which is rolled back if any of it
+        fails.  Returns the number of resources written"""
+        facilities = {}
+        support_centers = {}
+        sites = {}
+        groups = {}
+        resources = {}
+        # Rows of the details tables, by resource ID.  A resource ID repeated further on in the file replaces the
+        # earlier resource, details and all.  contacts keeps the resources in file order, for numbering the persons
+        services = {}
+        vo_ownership = {}
+        contacts = collections.OrderedDict()
+
+        for record, resourcerecord, details in topology.iter_resource_records(source, topology.details_extractor):
+            facilities[record['FacilityID']] = (record['FacilityID'], record['FacilityName'])
+            support_center_id = int(record['SupportCenterID'])
+            support_centers[support_center_id] = (support_center_id, record['SupportCenterName'])
+            sites[record['SiteID']] = (record['SiteID'], record['SiteName'], record['FacilityID'], support_center_id)
+            group_id = int(record['GroupID'])
+            groups[group_id] = (group_id, record['GroupName'], record['GridType'], record['SiteID'])
+
+            resource_id = int(resourcerecord['ID'])
+            wlcg = details.get('WLCG') or {}
+            resources[resource_id] = (resource_id, resourcerecord['Name'], resourcerecord['FQDN'], group_id,
+                                      _flag(resourcerecord['Active']), _flag(resourcerecord['Disable']),
+                                      wlcg.get('Available'), wlcg.get('AccountingName'))
+            services[resource_id] = [(resource_id, service) for service in resourcerecord['Services']]
+            vo_ownership[resource_id] = [(resource_id, ownership['VO'], ownership['Percent'])
+                                         for ownership in details.get('VOOwnership', ())]
+            contacts[resource_id] = [(contactlist['ContactType'], contact['Name'], contact['ContactRank'])
+                                     for contactlist in details.get('ContactLists', ())
+                                     for contact in contactlist['Contacts']]
+
+        # Each person once, numbered in the order they are first seen, and the resources they are a contact for
+        persons = collections.OrderedDict()
+        resource_persons = []
+        for resource_id, resource_contacts in contacts.iteritems():
+            for contact_type, name, rank in resource_contacts:
+                person_id = persons.setdefault(name, len(persons) + 1)
+                resource_persons.append((resource_id, person_id, contact_type, rank))
+
+        with self.conn:
+            for table in DATA_TABLES:
+                self.conn.execute('DELETE FROM {0}'.format(table))
+            self.conn.executemany('INSERT INTO facilities VALUES (?, ?)', facilities.itervalues())
+            self.conn.executemany('INSERT INTO support_centers VALUES (?, ?)', support_centers.itervalues())
+            self.conn.executemany('INSERT INTO sites VALUES (?, ?, ?, ?)', sites.itervalues())
+            self.conn.executemany('INSERT INTO resource_groups VALUES (?, ?, ?, ?)', groups.itervalues())
+            self.conn.executemany('INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)', resources.itervalues())
+            self.conn.executemany('INSERT INTO services VALUES (?, ?)', itertools.chain(*services.itervalues()))
+            self.conn.executemany('INSERT INTO vo_ownership VALUES (?, ?, ?)',
+                                  itertools.chain(*vo_ownership.itervalues()))
+            self.conn.executemany('INSERT INTO persons VALUES (?, ?, NULL)',
+                                  ((person_id, name) for name, person_id in persons.iteritems()))
+            self.conn.executemany('INSERT INTO resource_persons VALUES (?, ?, ?, ?)', resource_persons)
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('source_key', source_key))
+        return len(resources)
+
+    def _resources(self, where, params):
+        return [dict(row) for row in self.conn.execute(RESOURCE_QUERY + where + ' ORDER BY r.id', params)]
+
+    def resource(self, resource_id):
+        """Returns the resource with the OIM ID resource_id, or None"""
+        resources = self._resources('WHERE r.id = ?', (resource_id,))
+        return resources[0] if resources else None
+
+    def resource_by_fqdn(self, fqdn):
+        """Returns the first resource with the FQDN fqdn, or None"""
+        resources = self._resources('WHERE r.fqdn = ? COLLATE NOCASE', (fqdn,))
+        return resources[0] if resources else None
+
+    def facility_of_fqdn(self, fqdn):
+        """Returns the name of the facility that owns the resource with the FQDN fqdn, or None"""
+        resource = self.resource_by_fqdn(fqdn)
+        return resource['facility'] if resource is not None else None
+
+    def resources_named(self, name):
+        return self._resources('WHERE r.name = ? COLLATE NOCASE', (name,))
+
+    def resources_by_accounting_name(self, accounting_name):
+        return self._resources('WHERE r.accounting_name = ? COLLATE NOCASE', (accounting_name,))
+
+    def resources_of_group(self, group):
+        """Returns the resources of the resource group with the OIM ID or name group"""
+        return self._resources('WHERE g.id = ? OR g.name = ? COLLATE NOCASE', (_id_or_none(group), group))
+
+    def resources_of_site(self, site):
+        """Returns the resources of the site with the OIM ID or name site"""
+        return self._resources('WHERE s.id = ? OR s.name = ? COLLATE NOCASE', (_id_or_none(site), site))
+
+    def resources_of_facility(self, facility):
+        """Returns the resources of the facility with the OIM ID or name facility"""
+        return self._resources('WHERE f.id = ? OR f.name = ? COLLATE NOCASE', (_id_or_none(facility), facility))
+
+    def resources_with_service(self, service):
+        return self._resources('WHERE r.id IN (SELECT resource_id FROM services WHERE name = ? COLLATE NOCASE)',
+                               (service,))
+
+    def resources_of_vo(self, vo):
+        """Returns the resources vo owns a share of"""
+        return self._resources('WHERE r.id IN (SELECT resource_id FROM vo_ownership WHERE vo = ? COLLATE NOCASE)',
+                               (vo,))
+
+    def resources_of_contact(self, name, contact_type=None):
+        """Returns the resources name is a contact for, in any contact list or only the contact_type one"""
+        query = 'SELECT l.resource_id FROM resource_persons l JOIN persons p ON p.id = l.person_id ' \
+                'WHERE p.name = ? COLLATE NOCASE'
+        params = (name,)
+        if contact_type is not None:
+            query += ' AND l.contact_type = ?'
+            params += (contact_type,)
+        return self._resources('WHERE r.id IN ({0})'.format(query), params)
+
+    def services(self, resource_id):
+        """Returns the names of the services of a resource"""
+        return [row[0] for row in self.conn.execute('SELECT name FROM services WHERE resource_id = ? ORDER BY rowid',
+                                                    (resource_id,))]
+
+    def vo_ownership(self, resource_id):
+        """Returns the VO ownership dictionary of a resource, in the format of the topology's: {<VO>: <percent>}"""
+        return dict(tuple(row) for row in self.conn.execute('SELECT vo, percent FROM vo_ownership '
+                                                            'WHERE resource_id = ?', (resource_id,)))
+
+    def contacts(self, resource_id, contact_type=None):
+        """Returns the (<ContactType>, <name>, <ContactRank>) of every contact of a resource, in file order,
+        optionally only those of contact_type"""
+        query = 'SELECT l.contact_type, p.name, l.rank FROM resource_persons l JOIN persons p ON p.id = l.person_id ' \
+                'WHERE l.resource_id = ?'
+        params = (resource_id,)
+        if contact_type is not None:
+            query += ' AND l.contact_type = ?'
+            params += (contact_type,)
+        return [tuple(row) for row in self.conn.execute(query + ' ORDER BY l.rowid', params)]
+
+    def person(self, name):
+        """Returns the person called name as {'id': <id>, 'name': <name>, 'email': <email>}, or None"""
+        row = self.conn.execute('SELECT id, name, email FROM persons WHERE name = ? COLLATE NOCASE', (name,)).fetchone()
+        return None if row is None else dict(row)
+
+
+def _id_or_none(key):
+    """Returns key as an OIM ID if it is one, or None so that it only matches names"""
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        return None
+
+
+def open_store(xml_file, db_file, **options):
+    """Returns the TopologyStore in db_file, first loading it from xml_file if it was loaded from anything else (a
+    different file, a changed one, or different options).  options are OIMTopology keyword arguments, e.g.
+    parse_filter"""
+    topology = OIMTopology(xml_file, **options)
+    store = TopologyStore(db_file)
+    try:
+        key = store.source_key(xml_file, topology)
+        if store.get_meta('source_key') != key:
+            store.load(topology, source_key=key)
+    except Exception:
+        store.close()
+        raise
+    return store
@@ -1,5 +1,390 @@
-from xml.dom import minidom
-from ast import literal_eval
+import os
+import re
+import csv
+import time
+import hashlib
+import collections
+import multiprocessing
+from xml.dom import minidom, pulldom, Node
+
+from OIMContacts import ContactRegistry
+from OIMInput import open_stream, open_buffer, parse_document
+from OIMModel import FrozenMap, FacilityRecord, SiteRecord, ResourceGroupRecord, ResourceRecord, LazyResourceRecord, \
+    RecordFactory, RecordPool
+
+# Bump this whenever a change to the parser changes the facilities dictionary it produces (including the classes of
+# the compact and lazy records it is pickled with), so cached topologies built by an older parser are not used
+PARSER_VERSION = 2
+
+
+# Modes of a FieldExtractor spec field, given as its optional fourth element.  Fields without one are optional: the
+# first match is kept and the key is None when nothing matches
+MANY = True                     # every match is collected into a list, which is empty when nothing matches
+REQUIRED = 'required'           # the first match is kept, and MissingElementError is raised when nothing matches
+
+
+class MissingElementError(ValueError):
+    """Raised when an element the OIM XML must have is not there.  path is the missing element's path, relative to
+    the element being extracted, and where (if known) names the resource group or resource it is missing from"""
+    def __init__(self, path, where=None):
+        ValueError.__init__(self, path, where)
+        self.path = path
+        self.where = where
+
+    def __str__(self):
+        if self.where is None:
+            return 'Missing required element {0}'.format(self.path)
+        return 'Missing required element {0} in {1}'.format(self.path, self.where)
+
+
+class FieldExtractor(object):
+    """Compiles a declarative extraction spec into a single pass over an XML element.
+
+    The spec is a list of (path, key, converter[, mode]) tuples.  path is a '/'-separated list of child element names
+    relative to the element being extracted, key is where the result goes in the returned record, and converter is
+    called with the matching element.  If mode is MANY every match is collected into a list, otherwise only the first
+    match is kept (like getElementsByTagName(...)[0]).  When nothing matches, the key is None, or MissingElementError
+    is raised if mode is REQUIRED.  Only the branches named in the spec are walked, and each of them only once, no
+    matter how many fields hang off of it."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.single_fields = []
+        self.many_keys = []
+        self.tree = {}
+        for field in spec:
+            path, key, converter = field[:3]
+            mode = field[3] if len(field) > 3 else None
+            many = mode is MANY
+            tags = path.split('/')
+            node = self.tree
+            for tag in tags[:-1]:
+                node = node.setdefault(tag, ({}, []))[0]
+            node.setdefault(tags[-1], ({}, []))[1].append((key, converter, many, path))
+            if many:
+                self.many_keys.append(key)
+            else:
+                self.single_fields.append((key, path, mode == REQUIRED))
+
+    def instrumented(self, stats, prefix):
+        """Returns a copy of this extractor that adds the time spent in each field's converter to stats, as the stage
+        prefix + key"""
+        spec = []
+        for field in self.spec:
+            path, key, converter = field[:3]
+            spec.append((path, key, stats.timed(prefix + key, converter)) + tuple(field[3:]))
+        return FieldExtractor(spec)
+
+    def extract(self, elt):
+        """Walks elt once and returns a record dictionary with every field in the spec filled in"""
+        record = {}
+        for key in self.many_keys:
+            record[key] = []
+        self._walk(elt, self.tree, record)
+        for key, path, required in self.single_fields:
+            if key not in record:
+                if required:
+                    raise MissingElementError(path)
+                record[key] = None
+        return record
+
+    def _walk(self, elt, tree, record):
+        """Recursive helper for extract.  Visits the element children of elt that are in the compiled tree"""
+        for child in elt.childNodes:
+            if child.nodeType != Node.ELEMENT_NODE:
+                continue
+            branch = tree.get(child.tagName)
+            if branch is None:
+                continue
+            subtree, fields = branch
+            for key, converter, many, path in fields:
+                try:
+                    if many:
+                        record[key].append(converter(child))
+                    elif key not in record:
+                        record[key] = converter(child)
+                except MissingElementError as e:
+                    # Raised by a nested extractor, so its path is relative to child
+                    raise MissingElementError(path + '/' + e.path)
+            if subtree:
+                self._walk(child, subtree, record)
+
+
+class ParseStats(object):
+    """Per-stage timers and counters collected by OIMTopology.parse(stats=...).  timers maps a stage to the seconds
+    spent in it and counters maps a counter to its count.  If callback is given, it is called with (<name>, <value>)
+    for every timing and count as it is recorded.
+
+    The stages are 'xml' (building the DOM), 'group' (extracting a resource group's fields), 'resource.<field>'
+    (decoding each field of every resource, e.g. 'resource.Disable'), 'filter' (deciding whether a resource is kept),
+    'details.<field>' (decoding VOOwnership, WLCG and ContactLists of the kept resources) and 'build' (building the
+    resource dictionaries).  The counters are 'resource_groups', 'skipped_groups', 'resources', 'skipped_disabled',
+    'skipped_inactive', 'skipped_services' (no CE or Connect service, with the default ParseFilter), 'skipped_vos',
+    'skipped_duplicate', 'resources_kept' and 'contacts'."""
+    def __init__(self, callback=None):
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.callback = callback
+
+    def add(self, stage, seconds):
+        """Adds seconds to the timer of stage"""
+        self.timers[stage] += seconds
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+    def count(self, counter, n=1):
+        """Adds n to counter"""
+        self.counters[counter] += n
+        if self.callback is not None:
+            self.callback(counter, n)
+
+    def timed(self, stage, func):
+        """Returns a wrapper of func that adds the time spent in each call to the timer of stage"""
+        def timed_func(*args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                self.add(stage, time.time() - start)
+        return timed_func
+
+    def merge(self, other):
+        """Adds the timers and counters of another ParseStats, e.g. one collected by a parse_parallel worker"""
+        for stage, seconds in other.timers.iteritems():
+            self.add(stage, seconds)
+        for counter, n in other.counters.iteritems():
+            self.count(counter, n)
+
+    def __getstate__(self):
+        # The callback stays behind when the stats of a worker process are sent back
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.timers.update(state['timers'])
+        self.counters.update(state['counters'])
+
+    def report(self):
+        """Returns the timers, slowest first, and the counters as printable text"""
+        lines = ['{0:30} {1:10.3f}s'.format(stage, seconds)
+                 for stage, seconds in sorted(self.timers.iteritems(), key=lambda item: -item[1])]
+        lines.extend('{0:30} {1:10d}'.format(counter, n) for counter, n in sorted(self.counters.iteritems()))
+        return '\n'.join(lines)
+
+
+def get_text(elt):
+    """Returns the text of an XML element"""
+    return elt.firstChild.data
+
+
+def get_int(elt):
+    """Returns the text of an XML element as an int"""
+    return int(elt.firstChild.data)
+
+
+def get_str(elt):
+    """Returns the text of an XML element as a str, or None if the element is empty"""
+    try:
+        return str(elt.firstChild.data)
+    except AttributeError:
+        return None
+
+
+def get_element(elt):
+    """Returns the XML element itself, for fields that are decoded later"""
+    return elt
+
+
+def get_wlcg_info(elt):
+    """Converts a WLCGInformation element into a dictionary of the form {'Available': <True/False>,
+    'AccountingName': <accountingname>}"""
+    wlcg = {}
+    if elt.firstChild.nodeValue == "(Information not available)":
+        wlcg['Available'] = False
+    else:
+        wlcg['Available'] = True
+        wlcg['AccountingName'] = WLCG_EXTRACTOR.extract(elt)['AccountingName']
+    return wlcg
+
+
+WLCG_EXTRACTOR = FieldExtractor([
+    ('AccountingName', 'AccountingName', get_str),
+])
+
+OWNERSHIP_EXTRACTOR = FieldExtractor([
+    ('VO', 'VO', get_str, REQUIRED),
+    ('Percent', 'Percent', lambda elt: float(elt.firstChild.data), REQUIRED),
+])
+
+CONTACT_EXTRACTOR = FieldExtractor([
+    ('Name', 'Name', get_text, REQUIRED),
+    ('ContactRank', 'ContactRank', get_str),
+])
+
+CONTACT_LIST_EXTRACTOR = FieldExtractor([
+    ('ContactType', 'ContactType', get_text, REQUIRED),
+    ('Contacts/Contact', 'Contacts', CONTACT_EXTRACTOR.extract, MANY),
+])
+
+# Fields needed to decide whether a resource is kept.  These are extracted for every resource in the file.
+RESOURCE_EXTRACTOR = FieldExtractor([
+    ('ID', 'ID', get_text, REQUIRED),
+    ('Name', 'Name', get_text, REQUIRED),
+    ('Active', 'Active', get_text),
+    ('Disable', 'Disable', get_text, REQUIRED),
+    ('Services/Service/Name', 'Services', get_text, MANY),
+    ('FQDN', 'FQDN', get_text, REQUIRED),
+])
+
+# Fields that are only extracted for the resources that are kept, by the resource dictionary key they are for
+RESOURCE_DETAILS_FIELDS = [
+    ('VOOwnership', ('VOOwnership/Ownership', 'VOOwnership', OWNERSHIP_EXTRACTOR.extract, MANY)),
+    ('WLCG', ('WLCGInformation', 'WLCG', get_wlcg_info, REQUIRED)),
+    ('Contacts', ('ContactLists/ContactList', 'ContactLists', CONTACT_LIST_EXTRACTOR.extract, MANY)),
+]
+
+RESOURCE_DETAILS_EXTRACTOR = FieldExtractor([field for _, field in RESOURCE_DETAILS_FIELDS])
+
+# Fields of a ResourceRow beyond those of RESOURCE_EXTRACTOR
+ROW_DETAILS_EXTRACTOR = FieldExtractor([
+    ('VOOwnership/Ownership', 'VOOwnership', OWNERSHIP_EXTRACTOR.extract, MANY),
+    ('WLCGInformation', 'WLCG', get_wlcg_info, REQUIRED),
+])
+
+# Flat, immutable record yielded by OIMTopology.iter_resources.  wlcg_available and accounting_name are the WLCG
+# information, and vo_shares is a tuple of (<VO>, <percent>) pairs in file order
+ResourceRow = collections.namedtuple('ResourceRow', [
+    'facility_id', 'facility', 'site_id', 'site', 'support_center_id', 'support_center', 'group_id', 'group',
+    'resource_id', 'resource', 'fqdn', 'wlcg_available', 'accounting_name', 'vo_shares'])
+
+# Keys of the resource dictionary that are always there, whatever the projection
+RESOURCE_KEYS = ('Name', 'ID', 'FQDN')
+
+# VO names of a resource, for ParseFilter.vos
+VO_EXTRACTOR = FieldExtractor([
+    ('VOOwnership/Ownership/VO', 'VOs', get_str, MANY),
+])
+
+RESOURCE_GROUP_EXTRACTOR = FieldExtractor([
+    ('GridType', 'GridType', get_text),
+    ('GroupID', 'GroupID', get_text, REQUIRED),
+    ('GroupName', 'GroupName', get_text, REQUIRED),
+    ('Facility/ID', 'FacilityID', get_int, REQUIRED),
+    ('Facility/Name', 'FacilityName', get_text, REQUIRED),
+    ('Site/ID', 'SiteID', get_int, REQUIRED),
+    ('Site/Name', 'SiteName', get_text, REQUIRED),
+    ('SupportCenter/ID', 'SupportCenterID', get_text, REQUIRED),
+    ('SupportCenter/Name', 'SupportCenterName', get_text, REQUIRED),
+    ('Resources/Resource', 'Resources', get_element, MANY),
+])
+
+# Just enough of a ResourceGroup to say which one it is when it turns out to be incomplete
+GROUP_NAME_EXTRACTOR = FieldExtractor([
+    ('GroupID', 'GroupID', get_str),
+    ('GroupName', 'GroupName', get_str),
+])
+
+
+def describe_group(record):
+    """Names the resource group of the (possibly incomplete) resource group record passed in, for error messages"""
+    if record.get('GroupName') is None and record.get('GroupID') is None:
+        return 'a ResourceGroup with no GroupName or GroupID'
+    return 'ResourceGroup {0} (GroupID {1})'.format(record.get('GroupName'), record.get('GroupID'))
+
+
+def extract_group_record(rgelt):
+    """RESOURCE_GROUP_EXTRACTOR.extract(rgelt), with the resource group named in any MissingElementError"""
+    try:
+        return RESOURCE_GROUP_EXTRACTOR.extract(rgelt)
+    except MissingElementError as e:
+        raise MissingElementError(e.path, describe_group(GROUP_NAME_EXTRACTOR.extract(rgelt)))
+
+
+def extract_resource_record(extractor, record, index, relt, name=None):
+    """extractor.extract(relt) for relt, the index'th Resource element of the resource group record passed in, with
+    the resource (called name, if known) and its group named in any MissingElementError"""
+    try:
+        return extractor.extract(relt)
+    except MissingElementError as e:
+        resource = 'Resource {0}'.format(name) if name is not None else 'Resource #{0}'.format(index + 1)
+        raise MissingElementError(e.path, '{0} of {1}'.format(resource, describe_group(record)))
+
+
+class ParseFilter(object):
+    """Which resource groups and resources OIMTopology.parse() keeps.  Every criterion that is None lets everything
+    through; the defaults are the rules the parser has always applied.
+
+    Resource groups are kept if their facility ID or name is in facilities, their site ID is in sites and their
+    GridType is in grid_types.  These only need the leading fields of a ResourceGroup, so groups that don't match are
+    rejected before their resources are decoded (and, where the parser works on raw ResourceGroup blocks, before the
+    block is parsed at all).  Resources are kept if their Disable element reads disabled and their Active element
+    reads active, so by default resources with <Disable>True</Disable> are skipped and Active is not looked at.  They
+    also need at least one of the services, and at least one of the vos must have a share of them"""
+    def __init__(self, facilities=None, sites=None, grid_types=None, services=('CE', 'Connect'), vos=None,
+                 active=None, disabled=False):
+        self.facilities = self._set(facilities)
+        self.sites = self._set(sites)
+        self.grid_types = self._set(grid_types)
+        self.services = self._set(services)
+        self.vos = self._set(vos)
+        self.active = active
+        self.disabled = disabled
+        # The Active and Disable texts the resources kept have, so that they are compared without decoding them
+        self.active_text = None if active is None else str(bool(active))
+        self.disabled_text = None if disabled is None else str(bool(disabled))
+
+    @staticmethod
+    def _set(values):
+        if values is None:
+            return None
+        return frozenset(values)
+
+    def filters_groups(self):
+        """True if any of the resource group criteria is set"""
+        return self.facilities is not None or self.sites is not None or self.grid_types is not None
+
+    def match_group(self, record):
+        """True if the resource group record passed in is kept"""
+        if self.grid_types is not None and record['GridType'] not in self.grid_types:
+            return False
+        if self.facilities is not None and record['FacilityID'] not in self.facilities \
+                and record['FacilityName'] not in self.facilities:
+            return False
+        if self.sites is not None and record['SiteID'] not in self.sites:
+            return False
+        return True
+
+    def skip_resource(self, record):
+        """Returns why the resource record passed in is not kept ('disabled', 'inactive' or 'services'), or None.  The
+        vos criterion is checked separately, by match_vos, since it needs more of the resource to be decoded"""
+        if self.disabled_text is not None and record['Disable'] != self.disabled_text:
+            return 'disabled'
+        if self.active_text is not None and record['Active'] != self.active_text:
+            return 'inactive'
+        if self.services is not None and self.services.isdisjoint(record['Services']):
+            return 'services'
+        return None
+
+    def match_vos(self, vos):
+        """True if any of the VO names passed in is one of self.vos"""
+        return self.vos is None or not self.vos.isdisjoint(vos)
+
+    def key(self):
+        """Returns a tuple that is equal for equal filters and has a stable repr, for cache keys"""
+        return tuple(tuple(sorted(criterion)) if isinstance(criterion, frozenset) else criterion
+                     for criterion in (self.facilities, self.sites, self.grid_types, self.services, self.vos,
+                                       self.active, self.disabled))
+
+    def __eq__(self, other):
+        return isinstance(other, ParseFilter) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'ParseFilter{0!r}'.format(self.key())
 
 
 class Facility(object):
@@ -10,10 +395,9 @@ class Facility(object):
         self.sites = {}
         self.facility = {}
 
-    def parse(self, parent_elt):
-        """Grabs the facility ID from the XML element passed in from outside the class"""
-        facilityelt = parent_elt.getElementsByTagName('Facility')[0]
-        self.id = int(facilityelt.getElementsByTagName('ID')[0].firstChild.data)
+    def parse(self, record):
+        """Grabs the facility ID from the resource group record passed in from outside the class"""
+        self.id = record['FacilityID']
         return
 
     def build_dict(self):
@@ -24,6 +408,10 @@ class Facility(object):
         self.facility['Sites'] = self.sites
         return self.facility
 
+    def build_record(self, pool=None):
+        """Builds and returns the compact, read-only FacilityRecord equivalent of build_dict()"""
+        return FacilityRecord(self.name, self.id, self.sites)
+
 
 class Site(object):
     """Site class to hold information at the site level"""
@@ -34,22 +422,18 @@ class Site(object):
         self.supportcenter = {}
         self.site = {}
 
-    def parse(self, parent_elt):
-        """Gets the site ID, Support Center information from the XML element passed in"""
-        siteelt = parent_elt.getElementsByTagName('Site')[0]
-        self.id = int(siteelt.getElementsByTagName('ID')[0].firstChild.data)
-        self.supportcenter = self.get_support_center_dict(parent_elt)
+    def parse(self, record):
+        """Gets the site ID, Support Center information from the resource group record passed in"""
+        self.id = record['SiteID']
+        self.supportcenter = self.get_support_center_dict(record)
         return
 
-    def get_support_center_dict(self, parent_elt):
-        """Parses the XML element passed in to generate and return a dictionary of Support Center information.  The
-        format is {'Name':<name>, 'ID':<ID>}"""
+    def get_support_center_dict(self, record):
+        """Uses the resource group record passed in to generate and return a dictionary of Support Center
+        information.  The format is {'Name':<name>, 'ID':<ID>}"""
         self.supportcenter = {}
-        supportcenterelt = parent_elt.getElementsByTagName('SupportCenter')[0]
-        supportcentername = supportcenterelt.getElementsByTagName('Name')[0].firstChild.data
-        supportcenterid = supportcenterelt.getElementsByTagName('ID')[0].firstChild.data
-        self.supportcenter['Name'] = supportcentername
-        self.supportcenter['ID'] = supportcenterid
+        self.supportcenter['Name'] = record['SupportCenterName']
+        self.supportcenter['ID'] = record['SupportCenterID']
         return self.supportcenter
 
     def build_dict(self):
@@ -61,6 +445,14 @@ class Site(object):
         self.site['ResourceGroups'] = self.resourcegroups
         return self.site
 
+    def build_record(self, pool=None):
+        """Builds and returns the compact, read-only SiteRecord equivalent of build_dict().  Records that can be shared
+        are built by pool, an OIMModel.RecordFactory"""
+        if pool is None:
+            pool = RecordFactory()
+        supportcenter = pool.support_center(self.supportcenter['Name'], self.supportcenter['ID'])
+        return SiteRecord(self.name, self.id, supportcenter, self.resourcegroups)
+
 
 class ResourceGroup(object):
     """Class to hold the Resource Group-level information"""
@@ -70,9 +462,9 @@ class ResourceGroup(object):
         self.resources = {}
         self.rg = {}
 
-    def parse(self, parent_elt):
-        """Grabs the Resource Group ID from the XML element passed in"""
-        self.id = parent_elt.getElementsByTagName('GroupID')[0].firstChild.data
+    def parse(self, record):
+        """Grabs the Resource Group ID from the resource group record passed in"""
+        self.id = record['GroupID']
         return
 
     def build_dict(self):
@@ -83,6 +475,10 @@ class ResourceGroup(object):
         self.rg['Resources'] = self.resources
         return self.rg
 
+    def build_record(self, pool=None):
+        """Builds and returns the compact, read-only ResourceGroupRecord equivalent of build_dict()"""
+        return ResourceGroupRecord(self.name, self.id, self.resources)
+
 
 class Resource(object):
     """Class to hold the resource-level information"""
@@ -92,61 +488,47 @@ class Resource(object):
         self.fqdn = ''
         self.resource = {}
 
-    def parse(self, parent_elt):
-        """Grabs the Resource ID, FQDN, VO Ownership information, WLCG information, and Contacts from the XML element
-        passed in"""
-        self.id = parent_elt.getElementsByTagName('ID')[0].firstChild.data
-        self.fqdn = parent_elt.getElementsByTagName('FQDN')[0].firstChild.data
-        self.resource['VOOwnership'] = self.get_vo_ownership_dict(parent_elt)
-        self.resource['WLCG'] = self.get_wlcg_info(parent_elt)
-        self.resource['Contacts'] = self.get_contact_info(parent_elt)
+    def parse(self, record):
+        """Grabs the Resource ID, FQDN, VO Ownership information, WLCG information, and Contacts from the resource
+        record passed in.  The VO Ownership, WLCG and Contacts are only grabbed if the record has them, i.e. if they
+        weren't left out by a projection"""
+        self.id = record['ID']
+        self.fqdn = record['FQDN']
+        if 'VOOwnership' in record:
+            self.resource['VOOwnership'] = self.get_vo_ownership_dict(record)
+        if 'WLCG' in record:
+            self.resource['WLCG'] = self.get_wlcg_info(record)
+        if 'ContactLists' in record:
+            self.resource['Contacts'] = self.get_contact_info(record)
         return
 
-    def get_vo_ownership_dict(self, parent_elt):
-        """Generates and returns the VO Ownership dictionary from the XML element passed in.  The format is {<first_VO:
-        <ownership>, <second_vo>:<ownership>, etc}"""
+    def get_vo_ownership_dict(self, record):
+        """Generates and returns the VO Ownership dictionary from the resource record passed in.  The format is
+        {<first_VO: <ownership>, <second_vo>:<ownership>, etc}"""
         self.vo_ownership = {}
-        ownershiplist = parent_elt.getElementsByTagName('VOOwnership')[0].getElementsByTagName('Ownership')
-        for ownership in ownershiplist:
-            self.vo_ownership[str(ownership.getElementsByTagName('VO')[0].firstChild.data)] = float(
-                ownership.getElementsByTagName('Percent')[0].firstChild.data)
+        for ownership in record['VOOwnership']:
+            self.vo_ownership[ownership['VO']] = ownership['Percent']
         return self.vo_ownership
 
-    def get_wlcg_info(self, parent_elt):
-        """Generates and returns the WLCG information dictionary from the XML element passed in.  The format is
+    def get_wlcg_info(self, record):
+        """Generates and returns the WLCG information dictionary from the resource record passed in.  The format is
         {'Available': <True/False>, 'AccountingName':<accountingname>}"""
-        self.wlcg = {}
-        wlcgelt = parent_elt.getElementsByTagName('WLCGInformation')[0]
-        if wlcgelt.firstChild.nodeValue == "(Information not available)":
-            self.wlcg['Available'] = False
-        else:
-            self.wlcg['Available'] = True
-            try:
-                self.wlcg['AccountingName'] = str(wlcgelt.getElementsByTagName('AccountingName')[0].firstChild.data)
-            except AttributeError:
-                self.wlcg['AccountingName'] = None
+        self.wlcg = record['WLCG']
         return self.wlcg
 
-    def get_contact_info(self, parent_elt):
+    def get_contact_info(self, record):
         """Generates and returns the contacts information for each resource.  The format is {'Name1': {'Email': <None
         for now>, 'ContactRank': <rank>}, 'Name2': 'Email': <None for now>, 'ContactRank':<rank>}, etc.}"""
         self.contacts = {}
-        contactlistselt = parent_elt.getElementsByTagName('ContactLists')[0]
 
-        clelt_list = contactlistselt.getElementsByTagName('ContactList')
-        for clelt in clelt_list:
+        for contactlist in record['ContactLists']:
             # We only care about the Resource Report Contact list
-            if clelt.getElementsByTagName('ContactType')[0].firstChild.data == 'Resource Report Contact':
-                contactselt = clelt.getElementsByTagName('Contacts')[0]
-                celts = contactselt.getElementsByTagName('Contact')
-
-                for celt in celts:
-                    name = celt.getElementsByTagName('Name')[0].firstChild.data
-                    self.contacts[name] = {}
-                    contact = self.contacts[name]
-
+            if contactlist['ContactType'] == 'Resource Report Contact':
+                for contactrecord in contactlist['Contacts']:
+                    contact = {}
                     contact['Email'] = None
-                    contact['ContactRank'] = str(celt.getElementsByTagName('ContactRank')[0].firstChild.data)
+                    contact['ContactRank'] = contactrecord['ContactRank']
+                    self.contacts[contactrecord['Name']] = contact
 
         return self.contacts
 
@@ -156,93 +538,702 @@ class Resource(object):
         self.resource['Name'] = str(self.name)
         self.resource['ID'] = int(self.id)
         self.resource['FQDN'] = str(self.fqdn)
-        self.resource['VOOwnership'] = self.vo_ownership
-        self.resource['WLCG'] = self.wlcg
-        self.resource['Contacts'] = self.contacts
+        if hasattr(self, 'vo_ownership'):
+            self.resource['VOOwnership'] = self.vo_ownership
+        if hasattr(self, 'wlcg'):
+            self.resource['WLCG'] = self.wlcg
+        if hasattr(self, 'contacts'):
+            self.resource['Contacts'] = self.contacts
         return self.resource
 
+    def build_record(self, pool=None):
+        """Builds and returns the compact, read-only ResourceRecord equivalent of build_dict().  Records that can be
+        shared are built by pool, an OIMModel.RecordFactory"""
+        if pool is None:
+            pool = RecordFactory()
+        vo_ownership = wlcg = contacts = None
+        if hasattr(self, 'vo_ownership'):
+            vo_ownership = pool.vo_ownership(self.vo_ownership.iteritems())
+        if hasattr(self, 'wlcg'):
+            wlcg = pool.wlcg(self.wlcg)
+        if hasattr(self, 'contacts'):
+            contacts = FrozenMap((name, pool.contact(contact['Email'], contact['ContactRank']))
+                                 for name, contact in self.contacts.iteritems())
+        return ResourceRecord(str(self.name), int(self.id), str(self.fqdn), vo_ownership, wlcg, contacts)
+
+
+RESOURCE_GROUP_BLOCK_RE = re.compile(r'<ResourceGroup>.*?</ResourceGroup>', re.S)
+GROUP_ID_RE = re.compile(r'<GroupID>\s*([^<]*?)\s*</GroupID>')
+RESOURCE_BLOCK_RE = re.compile(r'<Resource>.*?</Resource>', re.S)
+# Start of the first of the fields RESOURCE_DETAILS_EXTRACTOR decodes, which come after the fields RESOURCE_EXTRACTOR
+# needs in every Resource element
+RESOURCE_DETAILS_RE = re.compile(r'<(?:VOOwnership|WLCGInformation|ContactLists)[\s/>]')
+# The same, for when the VOOwnership is needed to filter on VOs
+RESOURCE_DETAILS_AFTER_VO_RE = re.compile(r'<(?:WLCGInformation|ContactLists)[\s/>]')
+
+
+# Names of a ResourceGroup, for keying the blocks refresh() can't key by GroupID
+GROUP_NAMES_EXTRACTOR = FieldExtractor([
+    ('Facility/Name', 'FacilityName', get_str),
+    ('Site/Name', 'SiteName', get_str),
+    ('GroupName', 'GroupName', get_str),
+    ('GroupID', 'GroupID', get_str),
+])
+
+
+def iter_resource_group_blocks(data):
+    """Generator that yields (groupid, start, end) for every <ResourceGroup>...</ResourceGroup> block in the raw XML
+    data, without parsing it.  groupid is None if the block has no plain <GroupID> element"""
+    for match in RESOURCE_GROUP_BLOCK_RE.finditer(data):
+        groupid = GROUP_ID_RE.search(data, match.start(), match.end())
+        yield groupid and groupid.group(1), match.start(), match.end()
+
+
+def parse_block_header(data, start, end):
+    """Parses the fields ahead of the Resources of the raw ResourceGroup block at data[start:end] into a minidom
+    Document"""
+    header_end = data.find('<Resources', start, end)
+    if header_end < 0:
+        header_end = data.rfind('</ResourceGroup>', start, end)
+    return minidom.parseString(data[start:header_end] + '</ResourceGroup>')
+
+
+# Keys of the resource details a lazy resource keeps, in the order decode_resource_details returns them
+LAZY_DETAILS = tuple(key for key, _ in RESOURCE_DETAILS_FIELDS)
+
+# Extractors of decode_resource_details, by the details they extract
+details_extractors = {LAZY_DETAILS: RESOURCE_DETAILS_EXTRACTOR}
+
+
+def decode_resource_details(xml_file, start, end, compact, details=LAZY_DETAILS):
+    """Decoder of the LazyResourceRecords built by OIMTopology(xml_file, lazy=True).  Reads the Resource element at
+    bytes start to end of xml_file and returns its (VOOwnership, WLCG, Contacts), as compact records if compact is True
+    and as dictionaries otherwise.  Only the keys in details are decoded; the others are None"""
+    extractor = details_extractors.get(details)
+    if extractor is None:
+        extractor = details_extractors[details] = FieldExtractor([field for key, field in RESOURCE_DETAILS_FIELDS
+                                                                  if key in details])
+    with open(xml_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    d = minidom.parseString(data)
+    try:
+        record = extractor.extract(d.documentElement)
+    except MissingElementError as e:
+        raise MissingElementError(e.path, 'the Resource at bytes {0}-{1} of {2}'.format(start, end, xml_file))
+    finally:
+        d.unlink()
+
+    resource = Resource(None)
+    if 'VOOwnership' in record:
+        resource.get_vo_ownership_dict(record)
+    if 'WLCG' in record:
+        resource.get_wlcg_info(record)
+    if 'ContactLists' in record:
+        resource.get_contact_info(record)
+    built = resource.build_record() if compact else resource.build_dict()
+    return built.get('VOOwnership'), built.get('WLCG'), built.get('Contacts')
+
 
 class OIMTopology(object):
     """Class to hold the overall OIM topology information and parse it from an OIM xml file"""
     xml_file = 'resource_group_TEST.xml'
+    stats = None                        # ParseStats being collected, set by parse(stats=...) and instrument()
+    resource_extractor = RESOURCE_EXTRACTOR
+    details_extractor = RESOURCE_DETAILS_EXTRACTOR
+
+    def __init__(self, xml_file, compact=False, lazy=False, parse_filter=None, projection=None, contact_registry=None,
+                 flyweights=True):
+        """xml_file is normally a file name.  The serial parsers also take a file object or the XML data itself (see
+        OIMInput.is_data), but caching, refresh(), lazy and parallel parses need a file name.
+
+        If compact is True, the facilities dictionary is built from the __slots__ records in OIMModel instead of
+        plain dictionaries.  They read the same way but take a fraction of the memory, and can't be modified.
 
-    def __init__(self, xml_file):
+        If lazy is True, parse() only decodes the Name, ID and FQDN of each resource and builds a LazyResourceRecord
+        holding where the resource is in the XML file.  Its VOOwnership, WLCG and Contacts are decoded from the file
+        the first time one of them is read, so the file must not change while the topology is in use.
+
+        parse_filter is a ParseFilter saying which resource groups and resources to keep.  By default disabled
+        resources and resources without a CE or Connect service are dropped.
+
+        projection says which fields to build, e.g. {'Resource': ['ID', 'Name', 'FQDN']}.  Only the Resource level can
+        be projected, and a resource always has its Name, ID and FQDN; any of VOOwnership, WLCG and Contacts that is
+        not listed is never decoded and is not a key of the resource, lazy or not.
+
+        If contact_registry is an OIMContacts.ContactRegistry, the people in every contact list (of any ContactType)
+        of each kept resource are registered in it as the resource is parsed.  That needs the contact lists to be
+        decoded, so it can't be combined with lazy or with a projection that drops Contacts, and parse() doesn't use
+        its cache.
+
+        If flyweights is True, the VO names, contact names, ContactTypes, ContactRanks and support center names and
+        IDs that repeat all over the file are interned, so the topology holds one copy of each, and a compact topology
+        shares one record between all equal contacts, support centers, WLCG informations and VO ownerships (see
+        OIMModel.RecordPool).  The dictionaries of a non-compact topology are never shared, since they can be
+        modified"""
+        if contact_registry is not None and lazy:
+            raise ValueError("A contact registry can't be filled by a lazy parse")
         self.xml_file = xml_file
+        self.compact = compact
+        self.lazy = lazy
+        self.parse_filter = parse_filter if parse_filter is not None else ParseFilter()
+        self.contact_registry = contact_registry
+        self.flyweights = flyweights
+        self.pool = RecordPool() if flyweights else RecordFactory()
+        self.resource_fields = None     # Resource keys kept by the projection, or None for all of them
+        self.trim_re = None             # Regex matching the Resource subelements the projection drops, if any
+        if projection is not None:
+            self.set_projection(projection)
         self.facilities = {}
+        self.fingerprints = {}          # {<block key>: <digest of the ResourceGroup block>}, kept by refresh()
+        self.block_group_ids = {}       # {<block key>: <GroupID>} of the blocks not keyed by their GroupID
+        self.group_paths = {}           # {<GroupID>: (<facility name>, <site name>, <group name>)}
 
-    def parse(self):
+    def parse(self, streaming=False, cache=None, processes=None, stats=None):
         """Method to parse the OIM XML file, instantiate the appropriate classes, and generate the self.facilities
-        dictionary"""
-        d = minidom.parse(self.xml_file)
-        resourcegroupselts = d.getElementsByTagName('ResourceGroup')
+        dictionary.  If streaming is True, the file is read incrementally and each ResourceGroup element is freed as
+        soon as it has been added, so memory use stays flat no matter how many resource groups the file holds.  If a
+        TopologyCache is passed in as cache, a cached facilities dictionary for the same file contents is used
+        instead of parsing, and a fresh parse is written back to the cache (a failure to write it is only logged).  If
+        processes is more than 1, the file is parsed by a pool of that many processes (see parse_parallel).  A lazy
+        topology is always parsed by parse_lazy, whatever streaming and processes are, and a topology whose
+        parse_filter selects resource groups or whose projection drops resource fields is parsed by parse_blocks
+        unless streaming is True.
+
+        If stats is a ParseStats (or True, for a new one), per-stage timers and counters are collected into it and it
+        is returned.  Otherwise nothing is collected and None is returned"""
+        if stats is True:
+            stats = ParseStats()
+        if stats is not None:
+            self.instrument(stats)
+        try:
+            if self.contact_registry is not None:
+                cache = None
+            if cache is not None:
+                key = cache.key(self.xml_file, self.cache_options())
+                facilities = cache.get(key)
+                if facilities is not None:
+                    self.facilities = facilities
+                    if stats is not None:
+                        stats.count('cache_hits')
+                    return stats
+
+            if self.lazy:
+                self.parse_lazy()
+            elif processes is not None and processes > 1:
+                self.parse_parallel(processes)
+            elif (self.parse_filter.filters_groups() or self.trim_re is not None) and not streaming:
+                self.parse_blocks()
+            else:
+                self.add_resource_groups(self.xml_file, streaming)
+
+            if cache is not None:
+                cache.put(key, self.facilities)
+        finally:
+            if stats is not None:
+                self.instrument(None)
+        return stats
+
+    def instrument(self, stats):
+        """Starts collecting per-stage timers and counters into the ParseStats stats for everything this topology
+        parses, or stops collecting if stats is None.  When nothing is collected, the parse code only pays for a few
+        'is None' checks"""
+        if stats is None:
+            self.__dict__.pop('stats', None)
+            if '_extractors' in self.__dict__:
+                self.resource_extractor, self.details_extractor = self.__dict__.pop('_extractors')
+        else:
+            if '_extractors' not in self.__dict__:
+                self._extractors = (self.resource_extractor, self.details_extractor)
+            resource_extractor, details_extractor = self._extractors
+            self.stats = stats
+            self.resource_extractor = resource_extractor.instrumented(stats, 'resource.')
+            self.details_extractor = details_extractor.instrumented(stats, 'details.')
+
+    def set_projection(self, projection):
+        """Checks the projection passed to __init__ and builds the extractor for the resource details it keeps"""
+        fields = set()
+        for level, keys in projection.iteritems():
+            if level != 'Resource':
+                raise ValueError("Only the Resource level can be projected, not {0}".format(level))
+            fields.update(keys)
+        unknown = fields.difference(RESOURCE_KEYS, [key for key, _ in RESOURCE_DETAILS_FIELDS])
+        if unknown:
+            raise ValueError("Unknown Resource fields {0}".format(', '.join(sorted(unknown))))
+        if self.contact_registry is not None and 'Contacts' not in fields:
+            raise ValueError("A contact registry needs the Contacts field")
+
+        self.resource_fields = frozenset(fields.union(RESOURCE_KEYS))
+        self.details_extractor = FieldExtractor([field for key, field in RESOURCE_DETAILS_FIELDS
+                                                 if key in self.resource_fields])
+
+        # The elements that are dropped can be cut out of the raw XML before it is parsed, except for the VOOwnership
+        # if resources are filtered on VOs
+        tags = [field[0].split('/')[0] for key, field in RESOURCE_DETAILS_FIELDS if key not in self.resource_fields]
+        if self.parse_filter.vos is not None and 'VOOwnership' in tags:
+            tags.remove('VOOwnership')
+        if tags:
+            self.trim_re = re.compile(r'<({0})\b[^>]*?(?:/>|>.*?</\1>)'.format('|'.join(tags)), re.S)
+
+    def projection(self):
+        """Returns the projection this topology was made with, or None"""
+        if self.resource_fields is None:
+            return None
+        return {'Resource': sorted(self.resource_fields)}
+
+    def cache_options(self):
+        """Returns the options that change what parse() builds, for use in the cache key, or None if they are all at
+        their defaults"""
+        options = {}
+        if self.compact:
+            options['compact'] = True
+        if self.lazy:
+            # Lazy records read their details from the file they were parsed from when they are first used, so a
+            # cached lazy topology is only good for that very file, as it was then
+            xml_file = os.path.abspath(self.xml_file)
+            options['lazy'] = (xml_file, os.stat(xml_file).st_mtime)
+        if self.parse_filter != ParseFilter():
+            options['filter'] = self.parse_filter.key()
+        if self.resource_fields is not None:
+            options['projection'] = tuple(sorted(self.resource_fields))
+        return options or None
+
+    def build(self, entity):
+        """Returns the dictionary for a Facility, Site, ResourceGroup or Resource object, or its compact record if
+        this topology is compact"""
+        if self.compact:
+            return entity.build_record(self.pool)
+        return entity.build_dict()
+
+    def add_resource_groups(self, source, streaming=False):
+        """Parses every ResourceGroup in source (a file name, a file object or the XML data itself, see
+        OIMInput.is_data) and adds it to self.facilities.  This is how documents other than self.xml_file, such as
+        per-facility downloads, are merged into one topology"""
+        stats = self.stats
+        if streaming:
+            resourcegroupselts = self.iter_resource_groups(source)
+            if stats is not None:
+                resourcegroupselts = _timed_iter(resourcegroupselts, stats, 'xml')
+        else:
+            if stats is not None:
+                start = time.time()
+            d = parse_document(source)
+            if stats is not None:
+                stats.add('xml', time.time() - start)
+            resourcegroupselts = d.getElementsByTagName('ResourceGroup')
 
         # For each resource group in the XML file
         for rgelt in resourcegroupselts:
-            facilityelt = rgelt.getElementsByTagName('Facility')[0]
-            facilityname = facilityelt.getElementsByTagName('Name')[0].firstChild.data
-
-            # If it's a new facility, instantiate a Facility object, parse the XML for the relevant info
-            if facilityname not in self.facilities:
-                facility = Facility(facilityname)
-                facility.parse(rgelt)
-                self.facilities[facilityname] = facility.build_dict()
-
-            facility = self.facilities[facilityname]
-            sites = facility['Sites']                   # facilities[facilityname]['Sites']
-
-            siteelt = rgelt.getElementsByTagName('Site')[0]
-            sitename = siteelt.getElementsByTagName('Name')[0].firstChild.data
-
-            # If it's a new site, instantiate a Site object, parse the XML for the relevant info
-            if sitename not in sites:
-                site = Site(sitename)
-                site.parse(rgelt)
-                sites[sitename] = site.build_dict()
-
-            site = sites[sitename]
-            resourcegroups = site['ResourceGroups']     # facilities[facilityname]['Sites'][sitename]['ResourceGroups']
-
-            groupname = rgelt.getElementsByTagName('GroupName')[0].firstChild.data
-
-            # If it's a new resource group, instantiate a ResourceGroup object, parse the XML for the relevant info
-            if groupname not in resourcegroups:
-                rg = ResourceGroup(groupname)
-                rg.parse(rgelt)
-                resourcegroups[groupname] = rg.build_dict()
-
-            rg = resourcegroups[groupname]    # facilities[facilityname]['Sites'][sitename]['ResourceGroups'][groupname]
-            resourceelts = rgelt.getElementsByTagName('Resources')[0].getElementsByTagName('Resource')
-
-            # Populate the resources dictionary to put into the rg dictionary
-            resources = {}
-            # For each resource
-            for relt in resourceelts:
-                # Don't care about disabled resources
-                if literal_eval(relt.getElementsByTagName('Disable')[0].firstChild.data):
+            self.add_resource_group(rgelt)
+
+    def iter_resource_groups(self, source=None):
+        """Generator that reads the OIM XML file (or source, a file name, file object or XML data, see
+        OIMInput.is_data) incrementally and yields one fully-expanded ResourceGroup element at a time.  Each element
+        is unlinked once the caller is done with it, so only one ResourceGroup DOM is ever alive.  A file opened here
+        is closed once the generator is exhausted or closed"""
+        if source is None:
+            source = self.xml_file
+        with open_stream(source) as stream:
+            events = pulldom.parse(stream)
+            for event, node in events:
+                if event == pulldom.START_ELEMENT and node.tagName == 'ResourceGroup':
+                    events.expandNode(node)
+                    # The SAX parser can split text across buffer boundaries, so merge adjacent text nodes before
+                    # anything reads firstChild.data
+                    node.normalize()
+                    yield node
+                    node.unlink()
+
+    def refresh(self, xml_file=None):
+        """Incrementally brings self.facilities up to date with the OIM XML file (or with xml_file, which then
+        replaces self.xml_file).  Each ResourceGroup block is fingerprinted by GroupID, and only the blocks that were
+        added, changed or removed since the last refresh are parsed or dropped, so the cost scales with the number of
+        changes rather than the size of the file.  Facility and site details are kept from whichever group first
+        added them.  Returns a dictionary of the form {'added': [<keys>], 'changed': [...], 'removed': [...]}, where
+        the key of a block is its GroupID, or (<facility name>, <site name>, <group name>, <block number>) for a block
+        whose GroupID can't be read without parsing it or is the same as an earlier block's"""
+        if xml_file is not None:
+            self.xml_file = xml_file
+
+        with open_buffer(self.xml_file) as data:
+            # Without fingerprints from a previous refresh we can't tell what changed, so start from scratch
+            if not self.fingerprints:
+                self.facilities = {}
+                self.group_paths = {}
+                self.block_group_ids = {}
+
+            fingerprints = {}
+            block_group_ids = {}
+            blocks = []
+            for i, (groupid, start, end) in enumerate(iter_resource_group_blocks(data)):
+                key = groupid
+                if key is None or key in fingerprints:
+                    # Every block needs a key of its own, or blocks would overwrite each other's fingerprints
+                    d = parse_block_header(data, start, end)
+                    names = GROUP_NAMES_EXTRACTOR.extract(d.documentElement)
+                    d.unlink()
+                    key = (names['FacilityName'], names['SiteName'], names['GroupName'], i)
+                    block_group_ids[key] = names['GroupID']
+                fingerprints[key] = hashlib.sha1(data[start:end]).digest()
+                blocks.append((key, start, end))
+
+            changes = {'added': [], 'changed': [], 'removed': []}
+            for key in self.fingerprints:
+                if key not in fingerprints:
+                    changes['removed'].append(key)
+                    self.remove_resource_group(self.block_group_ids.get(key, key))
+
+            for key, start, end in blocks:
+                if key not in self.fingerprints:
+                    changes['added'].append(key)
+                elif self.fingerprints[key] != fingerprints[key]:
+                    changes['changed'].append(key)
+                    self.remove_resource_group(self.block_group_ids.get(key, key))
+                else:
+                    continue
+                if not self.match_block(data, start, end):
                     continue
+                d = self._parse_string(data[start:end])
+                self.add_resource_group(d.documentElement)
+                d.unlink()
 
-                # We only care about resources that have CE or Connect services.  Once we see that one of those
-                # is there at a facility, call it a Resource, get the info, and move onto the next resource
-                services = relt.getElementsByTagName('Services')[0].getElementsByTagName('Service')
+        self.fingerprints = fingerprints
+        self.block_group_ids = block_group_ids
+        return changes
 
-                for service in services:
-                    if service.getElementsByTagName('Name')[0].firstChild.data in ['CE', 'Connect']:
-                        resourcename = relt.getElementsByTagName('Name')[0].firstChild.data
+    def remove_resource_group(self, groupid):
+        """Removes the resource group with the given GroupID from self.facilities, along with its site and facility
+        if nothing else is left in them"""
+        if groupid not in self.group_paths:
+            return
+        facilityname, sitename, groupname = self.group_paths.pop(groupid)
+        if self.contact_registry is not None:
+            self.contact_registry.remove_group(groupid)
 
-                        # This should never happen, but just a check in case there's a duplicated resource in the
-                        # XML file
-                        if resourcename in resources:
-                            continue
+        sites = self.facilities[facilityname]['Sites']
+        resourcegroups = sites[sitename]['ResourceGroups']
+        resourcegroups.pop(groupname, None)
+        if not resourcegroups:
+            del sites[sitename]
+        if not sites:
+            del self.facilities[facilityname]
 
-                        # Instantiate a new Resource object, parse the XML file for the relevant info
-                        resource = Resource(resourcename)
-                        resource.parse(relt)
-                        resources[resourcename] = resource.build_dict()
-                        break
+    def add_resource_group(self, rgelt):
+        """Parses a single ResourceGroup XML element and adds its facility, site, resource group and resources to
+        the self.facilities dictionary"""
+        record = self.extract_resource_group(rgelt)
+        if self.match_group(record):
+            self.insert_resource_group(record, self.decode_resources(record))
 
-            # Add the resources dictionary to the resourcegroups dictionary
-            rg['Resources'] = resources
-        return
+    def match_group(self, record):
+        """True if the resource group record passed in passes self.parse_filter"""
+        if self.parse_filter.match_group(record):
+            return True
+        if self.stats is not None:
+            self.stats.count('skipped_groups')
+        return False
+
+    def match_block(self, data, start, end):
+        """True if the raw ResourceGroup block at data[start:end] passes the resource group criteria of
+        self.parse_filter.  Only the fields ahead of the block's Resources are parsed"""
+        if not self.parse_filter.filters_groups():
+            return True
+        d = self._timed(parse_block_header, data, start, end)
+        record = extract_group_record(d.documentElement)
+        d.unlink()
+        return self.match_group(record)
+
+    def extract_resource_group(self, rgelt):
+        """Returns the resource group record of a ResourceGroup XML element"""
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        record = extract_group_record(rgelt)
+        if self.flyweights:
+            intern = self.pool.intern
+            record['SupportCenterID'] = intern(record['SupportCenterID'])
+            record['SupportCenterName'] = intern(record['SupportCenterName'])
+        if stats is not None:
+            stats.add('group', time.time() - start)
+            stats.count('resource_groups')
+        return record
+
+    def intern_details(self, resourcerecord):
+        """Replaces the VO names, ContactTypes, contact names and ContactRanks in the details of the resource record
+        passed in by their interned copies"""
+        intern = self.pool.intern
+        for ownership in resourcerecord.get('VOOwnership', ()):
+            ownership['VO'] = intern(ownership['VO'])
+        for contactlist in resourcerecord.get('ContactLists', ()):
+            contactlist['ContactType'] = intern(contactlist['ContactType'])
+            for contact in contactlist['Contacts']:
+                contact['Name'] = intern(contact['Name'])
+                contact['ContactRank'] = intern(contact['ContactRank'])
+
+    def _parse_string(self, data):
+        """minidom.parseString, timed as the 'xml' stage if stats are being collected"""
+        return self._timed(minidom.parseString, data)
+
+    def _timed(self, parse, *args):
+        """Calls parse(*args), timed as the 'xml' stage if stats are being collected"""
+        stats = self.stats
+        if stats is None:
+            return parse(*args)
+        start = time.time()
+        d = parse(*args)
+        stats.add('xml', time.time() - start)
+        return d
+
+    def decode_resources(self, record, sources=None):
+        """Builds and returns the resources dictionary of the resource group record passed in, without touching
+        self.facilities.  If sources is given, it is a list of the (<xml file>, <start>, <end>) of each of the
+        record's Resource elements, and LazyResourceRecords are built instead of decoding the resource details"""
+        stats = self.stats
+        resources = {}
+        if sources is not None:
+            # The details a lazy resource decodes, and has as keys, are the ones the projection keeps
+            details = tuple(key for key in LAZY_DETAILS
+                            if self.resource_fields is None or key in self.resource_fields)
+        for i, relt, resourcerecord in self.iter_kept_resources(record):
+            resourcename = resourcerecord['Name']
+
+            if sources is not None and not self.details_extractor.spec:
+                # A projection that leaves out all the details leaves nothing to be lazy about
+                sources = None
+            if sources is not None:
+                resources[resourcename] = LazyResourceRecord(str(resourcename), int(resourcerecord['ID']),
+                                                             str(resourcerecord['FQDN']), decode_resource_details,
+                                                             sources[i] + (self.compact, details), details)
+                if stats is not None:
+                    stats.count('resources_kept')
+                continue
+
+            # Instantiate a new Resource object, extract the rest of the resource's fields for the relevant info
+            resourcerecord.update(extract_resource_record(self.details_extractor, record, i, relt, resourcename))
+            if self.flyweights:
+                self.intern_details(resourcerecord)
+            if self.contact_registry is not None:
+                self.contact_registry.add_resource(int(resourcerecord['ID']), record['GroupID'], record['FacilityID'],
+                                                   resourcerecord['ContactLists'])
+            if stats is not None:
+                start = time.time()
+            resource = Resource(resourcename)
+            resource.parse(resourcerecord)
+            resources[resourcename] = self.build(resource)
+            if stats is not None:
+                stats.add('build', time.time() - start)
+                stats.count('resources_kept')
+                stats.count('contacts', sum(len(contactlist['Contacts'])
+                                            for contactlist in resourcerecord.get('ContactLists', ())))
+        return resources
+
+    def iter_kept_resources(self, record):
+        """Generator that yields (<index>, <Resource element>, <resource record>) for each resource of the resource
+        group record passed in that passes self.parse_filter.  The resource record only has the fields of
+        self.resource_extractor"""
+        stats = self.stats
+        names = set()
+        # For each resource
+        for i, relt in enumerate(record['Resources']):
+            resourcerecord = extract_resource_record(self.resource_extractor, record, i, relt)
+            resourcename = resourcerecord['Name']
+
+            if stats is not None:
+                start = time.time()
+
+            # By default we don't care about disabled resources, and only care about resources that have CE or
+            # Connect services
+            skip = self.parse_filter.skip_resource(resourcerecord)
+            if skip is None and self.parse_filter.vos is not None \
+                    and not self.parse_filter.match_vos(VO_EXTRACTOR.extract(relt)['VOs']):
+                skip = 'vos'
+            # This should never happen, but just a check in case there's a duplicated resource in the XML file
+            if skip is None and resourcename in names:
+                skip = 'duplicate'
+
+            if stats is not None:
+                stats.add('filter', time.time() - start)
+                stats.count('resources')
+                if skip is not None:
+                    stats.count('skipped_' + skip)
+            if skip is not None:
+                continue
+
+            names.add(resourcename)
+            yield i, relt, resourcerecord
+
+    def iter_resource_records(self, source=None, details_extractor=ROW_DETAILS_EXTRACTOR):
+        """Generator that streams the OIM XML file (or source, a file name or file object) and yields (<resource group
+        record>, <resource record>, <details>) for every resource that passes self.parse_filter, as soon as its
+        ResourceGroup has been read.  The resource record has the fields of self.resource_extractor and details those
+        of details_extractor.  Nothing is added to self.facilities"""
+        resourcegroupselts = self.iter_resource_groups(source)
+        if self.stats is not None:
+            resourcegroupselts = _timed_iter(resourcegroupselts, self.stats, 'xml')
+
+        for rgelt in resourcegroupselts:
+            record = self.extract_resource_group(rgelt)
+            if not self.match_group(record):
+                continue
+            for i, relt, resourcerecord in self.iter_kept_resources(record):
+                details = extract_resource_record(details_extractor, record, i, relt, resourcerecord['Name'])
+                if self.flyweights:
+                    self.intern_details(details)
+                yield record, resourcerecord, details
+
+    def iter_resources(self, source=None):
+        """Generator that streams the OIM XML file (or source, a file name or file object) and yields a ResourceRow
+        for every resource that passes self.parse_filter, as soon as its ResourceGroup has been read.  Nothing is
+        added to self.facilities, so memory use stays flat and the first rows come out straight away"""
+        for record, resourcerecord, details in self.iter_resource_records(source):
+            wlcg = details['WLCG']
+            yield ResourceRow(record['FacilityID'], record['FacilityName'], record['SiteID'], record['SiteName'],
+                              record['SupportCenterID'], record['SupportCenterName'], record['GroupID'],
+                              record['GroupName'], int(resourcerecord['ID']), str(resourcerecord['Name']),
+                              str(resourcerecord['FQDN']), wlcg['Available'], wlcg.get('AccountingName'),
+                              tuple((ownership['VO'], ownership['Percent']) for ownership in details['VOOwnership']))
+
+    def write_csv(self, out, source=None):
+        """Streams the rows of iter_resources(source) to the file object out as CSV, with a header row.  VO shares
+        are written as <VO>:<percent> pairs separated by ';'"""
+        writer = csv.writer(out)
+        writer.writerow(ResourceRow._fields)
+        for row in self.iter_resources(source):
+            vo_shares = ';'.join('{0}:{1:g}'.format(vo, percent) for vo, percent in row.vo_shares)
+            writer.writerow([unicode(value).encode('utf-8') if isinstance(value, unicode) else value
+                             for value in row[:-1]] + [vo_shares])
+
+    def insert_resource_group(self, record, resources):
+        """Adds the facility, site and resource group of the resource group record passed in to self.facilities if
+        they are new, and sets the group's resources to the resources dictionary passed in"""
+        facilityname = record['FacilityName']
+
+        # If it's a new facility, instantiate a Facility object, parse the record for the relevant info
+        if facilityname not in self.facilities:
+            facility = Facility(facilityname)
+            facility.parse(record)
+            self.facilities[facilityname] = self.build(facility)
+
+        facility = self.facilities[facilityname]
+        sites = facility['Sites']                   # facilities[facilityname]['Sites']
+
+        sitename = record['SiteName']
+
+        # If it's a new site, instantiate a Site object, parse the record for the relevant info
+        if sitename not in sites:
+            site = Site(sitename)
+            site.parse(record)
+            sites[sitename] = self.build(site)
+
+        site = sites[sitename]
+        resourcegroups = site['ResourceGroups']     # facilities[facilityname]['Sites'][sitename]['ResourceGroups']
+
+        groupname = record['GroupName']
+
+        # If it's a new resource group, instantiate a ResourceGroup object, parse the record for the relevant info
+        if groupname not in resourcegroups:
+            rg = ResourceGroup(groupname)
+            rg.parse(record)
+            resourcegroups[groupname] = self.build(rg)
+
+        rg = resourcegroups[groupname]    # facilities[facilityname]['Sites'][sitename]['ResourceGroups'][groupname]
+
+        # The rg's resources dictionary is refilled rather than replaced so that compact (read-only) resource groups
+        # can be updated too
+        rg['Resources'].clear()
+        rg['Resources'].update(resources)
+
+        self.group_paths[record['GroupID']] = (facilityname, sitename, groupname)
+
+    def parse_blocks(self):
+        """Parses the OIM XML file one raw ResourceGroup block at a time, so that the blocks self.parse_filter rejects
+        are never parsed beyond their leading fields, and the Resource fields the projection drops are cut out of the
+        blocks before they are parsed"""
+        with open_buffer(self.xml_file) as data:
+            for _, start, end in iter_resource_group_blocks(data):
+                if not self.match_block(data, start, end):
+                    continue
+                block = data[start:end]
+                if self.trim_re is not None:
+                    block = self.trim_re.sub('', block)
+                d = self._parse_string(block)
+                self.add_resource_group(d.documentElement)
+                d.unlink()
+
+    def parse_lazy(self):
+        """Parses the OIM XML file for a lazy topology.  Each ResourceGroup block is parsed with its Resource elements
+        cut short before their VOOwnership, WLCG and ContactLists, so the DOM for those is never built, and each kept
+        resource becomes a LazyResourceRecord pointing back at its full Resource element in the file"""
+        # The records read their details back from the file whenever they are first used, so they must not depend on
+        # the current directory
+        xml_file = os.path.abspath(self.xml_file)
+        with open_buffer(self.xml_file) as data:
+            # The VOOwnership has to be parsed too if resources are filtered on it
+            details_re = RESOURCE_DETAILS_RE if self.parse_filter.vos is None else RESOURCE_DETAILS_AFTER_VO_RE
+
+            for _, start, end in iter_resource_group_blocks(data):
+                if not self.match_block(data, start, end):
+                    continue
+                rs_start = data.find('<Resources>', start, end)
+                if rs_start < 0:
+                    # <Resources/> or no resources at all
+                    self.add_resource_group(self._parse_string(data[start:end]).documentElement)
+                    continue
+                rs_start += len('<Resources>')
+                rs_end = data.rfind('</Resources>', rs_start, end)
+
+                pieces = [data[start:rs_start]]
+                sources = []
+                for match in RESOURCE_BLOCK_RE.finditer(data, rs_start, rs_end):
+                    details = details_re.search(data, match.start(), match.end())
+                    if details is None:
+                        pieces.append(match.group())
+                    else:
+                        pieces.append(data[match.start():details.start()] + '</Resource>')
+                    sources.append((xml_file, match.start(), match.end()))
+                pieces.append(data[rs_end:end])
+
+                d = self._parse_string(''.join(pieces))
+                record = self.extract_resource_group(d.documentElement)
+                if self.match_group(record):
+                    self.insert_resource_group(record, self.decode_resources(record, sources))
+                d.unlink()
+
+    def parse_parallel(self, processes, chunks_per_process=4):
+        """Parses the OIM XML file with a pool of processes.  The file is split on ResourceGroup boundaries into byte
+        ranges, each worker parses and decodes its ranges, and the decoded groups are then inserted into
+        self.facilities in file order, so the result is the same as a serial parse"""
+        with open_buffer(self.xml_file) as data:
+            blocks = [(start, end) for _, start, end in iter_resource_group_blocks(data)]
+        if not blocks:
+            return
+
+        # Split the blocks into contiguous chunks of roughly the same number of bytes
+        nchunks = min(len(blocks), processes * chunks_per_process)
+        chunk_bytes = (blocks[-1][1] - blocks[0][0]) / float(nchunks)
+        options = (self.compact, self.parse_filter, self.projection(), self.flyweights, self.stats is not None,
+                   self.contact_registry is not None)
+        chunks = []
+        chunk_start = blocks[0][0]
+        for start, end in blocks:
+            if end - chunk_start >= chunk_bytes:
+                chunks.append((self.xml_file, chunk_start, end) + options)
+                chunk_start = end
+        if chunk_start < blocks[-1][1]:
+            chunks.append((self.xml_file, chunk_start, blocks[-1][1]) + options)
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            for groups, stats, contact_registry in pool.imap(_parse_chunk, chunks):
+                if stats is not None:
+                    self.stats.merge(stats)
+                if contact_registry is not None:
+                    self.contact_registry.merge(contact_registry)
+                for record, resources in groups:
+                    self.insert_resource_group(record, resources)
+        finally:
+            pool.close()
+            pool.join()
 
     def test(self):
         """A function to test the generation of the facilities dictionary.  Run only after self.parse()"""
@@ -263,6 +1254,50 @@ class OIMTopology(object):
                         print '\t\t\t\tVOOwnership: {}'.format(resource['VOOwnership'])
 
 
+def _timed_iter(iterable, stats, stage):
+    """Generator that yields the items of iterable, adding the time spent getting each one to the timer of stage"""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stats.add(stage, time.time() - start)
+        yield item
+
+
+def _parse_chunk(args):
+    """Worker for OIMTopology.parse_parallel.  Parses the ResourceGroup blocks in one byte range of the XML file and
+    returns a list of (resource group record, resources dictionary) tuples, in file order, along with the worker's
+    ParseStats and ContactRegistry (or None for those that aren't being collected)"""
+    xml_file, start, end, compact, parse_filter, projection, flyweights, collect_stats, collect_contacts = args
+    with open(xml_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    contact_registry = ContactRegistry() if collect_contacts else None
+    topology = OIMTopology(xml_file, compact, parse_filter=parse_filter, projection=projection,
+                           contact_registry=contact_registry, flyweights=flyweights)
+    stats = None
+    if collect_stats:
+        stats = ParseStats()
+        topology.instrument(stats)
+    d = topology._parse_string('<ResourceSummary>' + data + '</ResourceSummary>')
+
+    groups = []
+    for rgelt in d.getElementsByTagName('ResourceGroup'):
+        record = topology.extract_resource_group(rgelt)
+        if not topology.match_group(record):
+            continue
+        resources = topology.decode_resources(record)
+        record['Resources'] = None      # The resource elements can't (and needn't) go back to the parent
+        groups.append((record, resources))
+    d.unlink()
+    return groups, stats, contact_registry
+
+
 def main():
     #infile = 'shortsample_resourcegroup.xml'
     infile = 'resource_group_TEST.xml'
@@ -273,10 +1308,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
-
-
@@ -0,0 +1,135 @@
+import os
+import errno
+import struct
+import hashlib
+import tempfile
+import zlib
+import logging
+import cPickle
+
+from OIMTopology import PARSER_VERSION
+
+log = logging.getLogger(__name__)
+
+
+class TopologyCache(object):
+    """On-disk cache of parsed OIM topologies.  Entries are keyed by a hash of the XML file's contents plus the parser
+    version, so a changed file or a parser change never gets a stale topology back.  The cache directory is kept under
+    max_bytes by evicting the least recently used entries."""
+    cache_dir = os.path.join(os.path.expanduser('~'), '.oim_topology_cache')
+    max_bytes = 256 * 1024 * 1024
+    chunk_size = 1024 * 1024
+    suffix = '.topology'
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, xml_file, options=None):
+        """Returns the cache key for xml_file.  options is anything that changes the parse output (e.g. parse mode
+        flags), and is folded into the key with its repr()"""
+        h = hashlib.sha1()
+        h.update('{0}:{1!r}:'.format(PARSER_VERSION, options))
+        with open(xml_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def path(self, key):
+        """Returns the path of the cache entry for key"""
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """Returns the cached facilities dictionary for key, or None if there is no usable entry.  Corrupt entries are
+        removed so the next parse can replace them"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        try:
+            checksum, = struct.unpack('!I', data[:4])
+            payload = data[4:]
+            if zlib.crc32(payload) & 0xffffffff != checksum:
+                raise ValueError("Checksum mismatch")
+            facilities = cPickle.loads(payload)
+        except Exception:
+            self.remove(key)
+            return None
+
+        # Touch the entry so eviction sees it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return facilities
+
+    def put(self, key, facilities):
+        """Writes the facilities dictionary to the cache under key, then evicts old entries if the cache directory is
+        over max_bytes.  The entry is written to a temp file and renamed, so readers never see a partial entry.  The
+        cache is only an optimization, so a failure to write it (an unpicklable topology, an unwritable directory, a
+        full disk) is logged rather than raised.  Returns True if the entry was written"""
+        try:
+            payload = cPickle.dumps(facilities, cPickle.HIGHEST_PROTOCOL)
+            fd, tmppath = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        except Exception as e:
+            log.warning("Not caching topology %s: %s", key, e)
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('!I', zlib.crc32(payload) & 0xffffffff))
+                f.write(payload)
+            os.rename(tmppath, self.path(key))
+        except Exception as e:
+            log.warning("Not caching topology %s: %s", key, e)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            return False
+        try:
+            self.evict()
+        except OSError as e:
+            log.warning("Could not evict old topologies from %s: %s", self.cache_dir, e)
+        return True
+
+    def remove(self, key):
+        """Removes the cache entry for key if there is one"""
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes the least recently used entries until the cache directory is no bigger than max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            total -= size
@@ -2,8 +2,12 @@
 
 """
 
+import os
 import sys
 
+from OIMInput import parse_document, is_path
+from OIMResolver import HostResolver
+
 __author__ = "Tanya Levshina"
 __email__ = "tlevshin@fnal.gov"
 
@@ -24,13 +28,25 @@ class Facility:
         self.old_rank = 0
         self.old_hours = 0
         self.contacts = []
+        self.contact_set = set()
         self.total = 0
+        self.resolver = None
+        self.resolver_groups = None
+
+    def add_contact(self, resource_group=None):
+        """Consolidates contacts from resource_group, or from all resource groups if it is None
 
-    def add_contact(self):
-        """Consolidates contacts from all resource groups"""
-        for resource_group in self.resource_groups:
+        Args:
+            resource_group(ResourceGroup) - the resource group that was just added
+        """
+        if resource_group is None:
+            resource_groups = self.resource_groups
+        else:
+            resource_groups = [resource_group]
+        for resource_group in resource_groups:
             for email in resource_group.contacts:
-                if email not in self.contacts:
+                if email not in self.contact_set:
+                    self.contact_set.add(email)
                     self.contacts.append(email)
 
     def get_resource_group_by_resource(self, resource_name):
@@ -44,22 +60,16 @@ class Facility:
         Returns:
             ResourceGroup: resource group that contained a specified resource, None is not found
         """
-        for resource_group in self.resource_groups:
-            # sometimes resource in gratia matches resource group in OIM
-            if resource_group.name.lower() == resource_name.lower():
-                return resource_group
-            # sometimes resource is a fqdn of the node where CE is running
-            for fqdns in resource_group.fqdns:
-                if fqdns.find(resource_name.lower()) >= 0:
-                    return resource_group
-
-            for resource in resource_group.resources:
-                # sometimes resource has addition as CE or a number , e.g BNL_ATLAS - Resource Group
-                # BNL_ATALAS_1 - Resource
-                if resource.name.lower() == resource_name.lower()\
-                        or resource.name.lower().find(resource_name.lower()) >= 0:
-                    return resource_group
-        return None
+        # sometimes resource in gratia matches resource group in OIM, sometimes resource is a fqdn of the node where
+        # CE is running, and sometimes resource has addition as CE or a number , e.g BNL_ATLAS - Resource Group
+        # BNL_ATALAS_1 - Resource.  HostResolver indexes all of these; rebuild it if the resource groups changed.
+        if self.resolver is None or self.resolver_groups != self.resource_groups:
+            self.resolver = HostResolver.from_facilities({self.name: self})
+            self.resolver_groups = list(self.resource_groups)
+        match = self.resolver.resolve(resource_name)
+        if match is None:
+            return None
+        return match[1]
 
     def get_sorted(self):
         """Sorts resource groups by used wall hours"""
@@ -79,6 +89,7 @@ class ResourceGroup:
         self.description = rgdescription
         self.resources = []
         self.contacts = []
+        self.contact_set = set()
         self.projects = []
         self.fqdns = []
         self.site = rgsite
@@ -91,7 +102,8 @@ class ResourceGroup:
     def add_contact(self, contacts):
         """add a new contact to the contact list"""
         for con in contacts:
-            if con not in self.contacts:
+            if con not in self.contact_set:
+                self.contact_set.add(con)
                 self.contacts.append(con)
 
     def get_resource(self, resource_name):
@@ -103,21 +115,23 @@ class ResourceGroup:
         Returns:
             Resource: resource group that contained a specified resource, None is not found
         """
+        name = resource_name.lower()
+        # sometimes resource is a fqdn of the node where CE is running.  That doesn't depend on the resource, so
+        # check it once rather than for every resource
+        fqdn_match = False
+        for fqdns in self.fqdns:
+            if fqdns.find(name) >= 0:
+                fqdn_match = True
+                break
         for resource in self.resources:
+            rname = resource.name.lower()
             # sometimes resource in gratia matches resource group in OIM
-            if resource.name.lower() == resource_name.lower():
-                return resource
-            # sometimes resource is a fqdn of the node where CE is running
-            for fqdns in self.fqdns:
-                if fqdns.find(resource_name.lower()) >= 0:
-                    return resource
             # sometimes resource has addition as CE or a number , e.g BNL_ATLAS - Resource Group
             # BNL_ATALAS_1 - Resource
-            if resource.name.lower() == resource_name.lower() or resource.name.lower().find(resource_name.lower()) >= 0\
-                    or resource_name.lower().find(resource.name.lower()):
+            if fqdn_match or rname.find(name) >= 0 or name.find(rname):
                 return resource
-        if self.name.lower() == resource_name.lower():
-            return self.resource[0]
+        if self.name.lower() == name and self.resources:
+            return self.resources[0]
         return None
 
     def get_sorted(self):
@@ -195,24 +209,46 @@ class OIMTopology:
     def __init__(self, filename, resource_topology):
         """
         Args:
-            filename(str) - xml file name
+            filename - xml file name, file object or xml data (see OIMInput.is_data)
             resource_topology - OIMResourceToplogy
         """
         self.filename = filename
         self.r_topology = resource_topology
-        self.r_topology.parse()
         self.facilities = {}
+        self.resolver = None
+        # If both topologies come from the same file, one walk over the resource topology's document builds the active
+        # CE resources and the facilities together, right here, and the document is then let go of.  Otherwise the
+        # resource topology is parsed now and the facilities are read from filename by parse()
+        self.shared = resource_topology.document is not None and resource_topology.is_same_file(filename)
+        if self.shared:
+            d = resource_topology.release_document()
+            self.load(d, add_resources=True)
+            d.unlink()
+        else:
+            self.r_topology.parse()
 
     def parse(self):
         """Parses the contact information that is hardcoded in contact.txt file. Ideally this information should
         come from OIM but currently OIM is missing readable description information and doesn't have site PI contacts.
-        The xml structure of contact file is preserved.
+        The xml structure of contact file is preserved.  A topology sharing its resource topology's file was already
+        parsed when it was made, so this just returns its facilities.
         """
-        import xml.dom.minidom
-        document = open(self.filename).readlines()
-        d = xml.dom.minidom.parseString(''.join(document))
+        if self.shared:
+            return self.facilities
+        d = parse_document(self.filename)
+        self.load(d)
+        d.unlink()
+        return self.facilities
+
+    def load(self, d, add_resources=False):
+        """Builds self.facilities from the document d.  If add_resources is True, every Resource element (even the
+        ones in disabled resource groups) is also added to the resource topology on the way, so that one walk over
+        the document builds both"""
         self.facilities = {}
         for resource_group_element in d.getElementsByTagName("ResourceGroup"):
+            if add_resources:
+                for r in resource_group_element.getElementsByTagName("Resource"):
+                    self.r_topology.add_resource(r)
             if resource_group_element.getElementsByTagName("Disable")[0].childNodes[0].data.strip() == "True":
                 continue
             site = resource_group_element.getElementsByTagName("Site")[0].childNodes[1].childNodes[0].data.strip()
@@ -246,13 +282,13 @@ class OIMTopology:
                     for c in cl.getElementsByTagName("Contact"):
                         for e in c.getElementsByTagName("Email"):
                             resource_group.add_contact([e.childNodes[0].data])
-            facility.add_contact()
+            facility.add_contact(resource_group)
         for fname in self.facilities.keys():
             f = self.facilities[fname]
             if len(f.resource_groups) == 0:
                 del self.facilities[fname]
 
-        return self.facilities
+        self.resolver = None
 
     # noinspection PyIncorrectDocstring
     def get_facility_by_resource(self, resource_name):
@@ -262,56 +298,71 @@ class OIMTopology:
         Returns:
             facility(Facility) - if finds it , otherwise returns None
         """
-        for fn, facility in self.facilities.items():
-            for resource_group in facility.resource_groups:
-                if resource_group.name.lower() == resource_name.lower():
-                    return facility
-                for fqdns in resource_group.fqdns:
-                    if fqdns.find(resource_name.lower()) >= 0:
-                        return facility
-                for resource in resource_group.resources:
-                    if resource.name.lower() == resource_name.lower()\
-                            or resource.name.lower().find(resource_name.lower()) >= 0:
-                        return facility
-        return None
+        if self.resolver is None:
+            self.resolver = HostResolver.from_facilities(self.facilities)
+        match = self.resolver.resolve(resource_name)
+        if match is None:
+            return None
+        return match[0]
 
 
 class OIMResourceGroupTopology:
     """Builds OIM hierarchy from OIM xml file (active CE resources)"""
     def __init__(self, filename):
-        import xml.dom.minidom
+        """
+        Args:
+            filename - xml file name, file object or xml data (see OIMInput.is_data)
+        """
         self.filename = filename
-        documents = open(self.filename).readlines()
-        self.document = xml.dom.minidom.parseString(''.join(documents))
+        self.document = parse_document(filename)
         self.resources = {}
 
+    def is_same_file(self, filename):
+        """Returns True if filename is the file this resource topology was read from"""
+        if not (is_path(filename) and is_path(self.filename)):
+            return filename is self.filename
+        return os.path.realpath(filename) == os.path.realpath(self.filename)
+
+    def release_document(self):
+        """Returns the parsed document and stops holding on to it, for a caller that walks it instead of parse()"""
+        d = self.document
+        self.document = None
+        return d
+
     def parse(self):
-        for r in self.document.getElementsByTagName("Resource"):
-            if r.getElementsByTagName("Disable")[0].childNodes[0].data.strip() == "True":
-                continue
-            vo_ownership = {}
-            for owner in r.getElementsByTagName("VOOwnership")[0].getElementsByTagName("Ownership"):    #Clean this up
+        """Adds the active CE resources of the document, then lets go of the document.  Does nothing if that was
+        already done"""
+        if self.document is None:
+            return
+        d = self.release_document()
+        for r in d.getElementsByTagName("Resource"):
+            self.add_resource(r)
+        d.unlink()
+
+    def add_resource(self, r):
+        """Adds the Resource element r to the active CE resources if it is enabled and has a CE or Connect service
+        Args:
+            r - Resource xml element
+        """
+        if r.getElementsByTagName("Disable")[0].childNodes[0].data.strip() == "True":
+            return
+        vo_ownership = {}
+        for owner in r.getElementsByTagName("VOOwnership")[0].getElementsByTagName("Ownership"):    #Clean this up
 #                print len(owner.childNodes)
 #                print owner.childNodes[1].childNodes[0].data.strip('[()]')      # VO
 #                print owner.childNodes[0].childNodes[0].data.strip('[()]')        # percentage
-                vo_ownership[owner.childNodes[1].childNodes[0].data.strip('[()]')] = owner.childNodes[0].childNodes[0].data.strip('[()]')
+            vo_ownership[owner.childNodes[1].childNodes[0].data.strip('[()]')] = owner.childNodes[0].childNodes[0].data.strip('[()]')
 
 #            print vo_ownership
 
-            # WLCG
-            WLCG = r.getElementsByTagName("WLCGInformation")[0].childNodes[0].nodeName  # Temp. var name
-            print WLCG
-            if WLCG == '#text':
-
-
-            for s in r.getElementsByTagName("Service"):
-                if s.getElementsByTagName("Name")[0].childNodes[0].data.strip() == "CE"\
-                        or s.getElementsByTagName("Name")[0].childNodes[0].data.strip() == "Connect":
-                    rid = r.getElementsByTagName("ID")[0].childNodes[0].data.strip()
-                    name = r.getElementsByTagName("Name")[0].childNodes[0].data.strip()
-                    fqdn = r.getElementsByTagName("FQDN")[0].childNodes[0].data.strip()
-                    self.resources[rid] = Resource(name, rid, fqdn, vo_ownership)
-                    break
+        for s in r.getElementsByTagName("Service"):
+            if s.getElementsByTagName("Name")[0].childNodes[0].data.strip() == "CE"\
+                    or s.getElementsByTagName("Name")[0].childNodes[0].data.strip() == "Connect":
+                rid = r.getElementsByTagName("ID")[0].childNodes[0].data.strip()
+                name = r.getElementsByTagName("Name")[0].childNodes[0].data.strip()
+                fqdn = r.getElementsByTagName("FQDN")[0].childNodes[0].data.strip()
+                self.resources[rid] = Resource(name, rid, fqdn, vo_ownership)
+                break
 
     def get_resource(self, resource_id):
         """Searches xml doc for specific resource id
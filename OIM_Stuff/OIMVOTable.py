@@ -0,0 +1,165 @@
+""" Columnar tables of the VO ownership of OIM resources.
+
+VOOwnershipTable turns the per-resource VOOwnership dictionaries of a topology into NumPy columns: every resource gets
+integer codes for its resource group, site, facility and support center, every VO is dictionary-encoded to an int,
+and each (resource, VO, percent) ownership entry is a row of three parallel arrays.  Questions like "what share of site
+X's CEs belong to CMS" then become vectorized group-bys over the whole grid, e.g.
+
+    table = VOOwnershipTable.from_rows(OIMTopology('resource_group_TEST.xml').iter_resources())
+    table.share('site', 'AGLT2', 'ATLAS')
+    sites, vos, shares = table.shares_by_site()
+
+The share of a VO in a site (facility, support center, resource group) is the mean, over the site's resources, of the
+fraction of each resource the VO owns, so it is between 0 and 1 and the shares of all VOs in a site add up to 1 if every
+resource's VOOwnership adds up to 100%.  The resources are the ones the topology kept, i.e. by default the CEs and
+Connect resources.  NumPy is needed to build a table.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Codes(object):
+    """Dictionary encoding of one column: each distinct key gets the next int code, in order of first appearance"""
+    def __init__(self):
+        self.keys = []
+        self.names = []
+        self.index = {}
+
+    def code(self, key, name=None):
+        """Returns the code of key, adding it (with its display name) if it is new"""
+        try:
+            return self.index[key]
+        except KeyError:
+            code = self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.names.append(name if name is not None else key)
+            return code
+
+    def lookup(self, key):
+        """Returns the code of key, or failing that of the first key with the display name key.  Raises KeyError if
+        there is neither"""
+        try:
+            return self.index[key]
+        except KeyError:
+            pass
+        try:
+            return self.names.index(key)
+        except ValueError:
+            raise KeyError(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class VOOwnershipTable(object):
+    """Integer-coded, columnar VO ownership of the resources of a topology.  Build it with from_rows or
+    from_facilities.
+
+    resource_ids holds the OIM ID of every resource, and resource_codes[level] the code of its resource group, site,
+    facility or support center (levels are 'group', 'site', 'facility' and 'support_center'), with codes[level] mapping
+    the codes back to OIM IDs and names.  ownership_resource, ownership_vo and ownership_percent are the ownership
+    entries: an index into the resource arrays, a code into vos and the percentage"""
+    levels = ('group', 'site', 'facility', 'support_center')
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("VOOwnershipTable needs numpy")
+        self.codes = dict((level, Codes()) for level in self.levels)
+        self.vos = Codes()
+        self._resource_ids = []
+        self._resource_codes = dict((level, []) for level in self.levels)
+        self._ownership = []
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the table from the ResourceRows yielded by OIMTopology.OIMTopology.iter_resources, without ever
+        building the facilities dictionary"""
+        table = cls()
+        for row in rows:
+            table.add_resource(row.resource_id, {
+                'group': (row.group_id, row.group),
+                'site': (row.site_id, row.site),
+                'facility': (row.facility_id, row.facility),
+                'support_center': (row.support_center_id, row.support_center),
+            }, row.vo_shares)
+        table.finish()
+        return table
+
+    @classmethod
+    def from_facilities(cls, facilities):
+        """Builds the table from the facilities dictionary (or compact records) built by
+        OIMTopology.OIMTopology.parse()"""
+        table = cls()
+        for facility in facilities.values():
+            for site in facility['Sites'].values():
+                supportcenter = site['SupportCenter']
+                for resourcegroup in site['ResourceGroups'].values():
+                    keys = {
+                        'group': (resourcegroup['ID'], resourcegroup['Name']),
+                        'site': (site['ID'], site['Name']),
+                        'facility': (facility['ID'], facility['Name']),
+                        'support_center': (supportcenter['ID'], supportcenter['Name']),
+                    }
+                    for resource in resourcegroup['Resources'].values():
+                        table.add_resource(resource['ID'], keys, resource['VOOwnership'].items())
+        table.finish()
+        return table
+
+    def add_resource(self, resource_id, keys, vo_shares):
+        """Adds a resource.  keys maps each level to the (<OIM ID>, <name>) of the resource's group, site, facility and
+        support center, and vo_shares is a sequence of (<VO>, <percent>) pairs"""
+        resource = len(self._resource_ids)
+        self._resource_ids.append(resource_id)
+        for level in self.levels:
+            key, name = keys[level]
+            self._resource_codes[level].append(self.codes[level].code(key, name))
+        for vo, percent in vo_shares:
+            self._ownership.append((resource, self.vos.code(vo), percent))
+
+    def finish(self):
+        """Turns the rows added so far into the NumPy columns"""
+        self.resource_ids = numpy.array(self._resource_ids, dtype=numpy.int64)
+        self.resource_codes = dict((level, numpy.array(self._resource_codes[level], dtype=numpy.int32))
+                                   for level in self.levels)
+        ownership = numpy.array(self._ownership, dtype=numpy.float64).reshape(-1, 3)
+        self.ownership_resource = ownership[:, 0].astype(numpy.int32)
+        self.ownership_vo = ownership[:, 1].astype(numpy.int32)
+        self.ownership_percent = ownership[:, 2]
+
+    def shares(self, level):
+        """Returns a (<number of level codes> x <number of VOs>) array of the share of each VO in each resource group,
+        site, facility or support center, by code"""
+        codes = self.resource_codes[level]
+        nkeys, nvos = len(self.codes[level]), len(self.vos)
+        owners = codes[self.ownership_resource]
+        totals = numpy.bincount(owners * nvos + self.ownership_vo, weights=self.ownership_percent,
+                                minlength=nkeys * nvos).reshape(nkeys, nvos)
+        counts = numpy.bincount(codes, minlength=nkeys)
+        return totals / (100.0 * numpy.maximum(counts, 1))[:, numpy.newaxis]
+
+    def labelled_shares(self, level):
+        """Returns (<names of the level, by code>, <VO names, by code>, shares(level))"""
+        return self.codes[level].names, self.vos.keys, self.shares(level)
+
+    def shares_by_site(self):
+        return self.labelled_shares('site')
+
+    def shares_by_facility(self):
+        return self.labelled_shares('facility')
+
+    def shares_by_support_center(self):
+        return self.labelled_shares('support_center')
+
+    def share(self, level, key, vo):
+        """Returns the share of vo in the resource group, site, facility or support center with the OIM ID or name
+        key, or 0.0 if the VO owns none of it.  Raises KeyError if there is no such key"""
+        code = self.codes[level].lookup(key)
+        if vo not in self.vos.index:
+            return 0.0
+        codes = self.resource_codes[level]
+        mask = codes[self.ownership_resource] == code
+        mask &= self.ownership_vo == self.vos.index[vo]
+        return self.ownership_percent[mask].sum() / (100.0 * numpy.count_nonzero(codes == code))
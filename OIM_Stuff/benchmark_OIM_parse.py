@@ -0,0 +1,340 @@
+""" Benchmarks the OIM topology parsers over the XML fixtures in this directory, over scale-ups of them and over
+synthetic documents written by generate_OIM_xml.
+
+For every fixture and parser path this records wall time, CPU time, peak RSS and live_objects, each run in a fresh
+child process so one run's memory doesn't leak into the next.  live_objects is the number of objects tracked by the
+garbage collector that the parse left alive, i.e. the size of the parsed topology in objects.  It is not a count of
+allocations: temporaries the parse freed again don't show up in it, but they do in peak RSS.  A run that fails, dies
+or takes longer than --timeout is recorded as an error rather than stopping the benchmark.  Results are written as JSON
+and can be compared with a stored baseline, e.g.
+
+    python benchmark_OIM_parse.py --output baseline.json
+    ... change the parser ...
+    python benchmark_OIM_parse.py --baseline baseline.json --output new.json
+
+exits with status 1 if any metric got worse than the baseline by more than --threshold.
+
+With --memory, it instead reports the deep size of the facilities dictionary each fixture parses into, in dictionary
+and compact mode, with and without the interned strings and shared records of OIMTopology(flyweights=True).
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import numbers
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+import OIMTopology
+import generate_OIM_xml
+import OIMTopology_NEW
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+fixtures = ['short_resource_group.xml', 'shortsample_resourcegroup.xml', 'resource_group.xml',
+            'resource_group_TEST.xml', 'resource_group_TEST_FORMATTED.xml', 'facility.xml']
+
+# File that is copied over and over to make the synthetic scale-ups
+scale_fixture = 'resource_group_TEST.xml'
+
+metrics = ['wall', 'cpu', 'peak_rss_kb', 'live_objects']
+
+
+def parse_dom(xml_file):
+    topology = OIMTopology.OIMTopology(xml_file)
+    topology.parse()
+    return topology
+
+
+def parse_streaming(xml_file):
+    topology = OIMTopology.OIMTopology(xml_file)
+    topology.parse(streaming=True)
+    return topology
+
+
+def parse_compact(xml_file):
+    topology = OIMTopology.OIMTopology(xml_file, compact=True)
+    topology.parse()
+    return topology
+
+
+def parse_lazy(xml_file):
+    topology = OIMTopology.OIMTopology(xml_file, lazy=True)
+    topology.parse()
+    return topology
+
+
+def parse_parallel(xml_file):
+    topology = OIMTopology.OIMTopology(xml_file)
+    topology.parse(processes=multiprocessing.cpu_count())
+    return topology
+
+
+def parse_new(xml_file):
+    """The OIMTopology_NEW two-file path, given the same file twice as in the README"""
+    topology = OIMTopology_NEW.OIMTopology(xml_file, OIMTopology_NEW.OIMResourceGroupTopology(xml_file))
+    topology.parse()
+    return topology
+
+
+paths = {
+    'dom': parse_dom,
+    'streaming': parse_streaming,
+    'compact': parse_compact,
+    'lazy': parse_lazy,
+    'parallel': parse_parallel,
+    'new': parse_new,
+}
+
+
+def _measure(path, xml_file, conn):
+    """Child process body: runs one parse and sends its measurements (or the error) back over conn"""
+    try:
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        cpu_before = sum(os.times()[:4])
+        wall_before = time.time()
+
+        topology = paths[path](xml_file)
+
+        wall = time.time() - wall_before
+        cpu = sum(os.times()[:4]) - cpu_before
+        gc.collect()
+        live_objects = len(gc.get_objects()) - objects_before
+        peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        del topology
+        conn.send({'wall': wall, 'cpu': cpu, 'peak_rss_kb': peak_rss_kb, 'live_objects': live_objects})
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    finally:
+        conn.close()
+
+
+def _run_child(path, xml_file, timeout):
+    """Runs _measure in a fresh process and returns what it sent back, or an error result if it died without sending
+    anything or was still running after timeout seconds"""
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target=_measure, args=(path, xml_file, child_conn))
+    p.start()
+    child_conn.close()
+    try:
+        deadline = time.time() + timeout
+        while not parent_conn.poll(0.1):
+            if not p.is_alive() and not parent_conn.poll():
+                return {'error': 'child exited with code {0} without a result'.format(p.exitcode)}
+            if time.time() > deadline:
+                p.terminate()
+                return {'error': 'timed out after {0}s'.format(timeout)}
+        try:
+            return parent_conn.recv()
+        except EOFError:
+            return {'error': 'child exited with code {0} without a result'.format(p.exitcode)}
+    finally:
+        parent_conn.close()
+        p.join()
+
+
+def measure(path, xml_file, repeat=1, timeout=600):
+    """Runs one parser path over xml_file repeat times, each in a fresh process, and returns the best of each
+    metric, or the error of the first run that failed"""
+    best = None
+    for _ in range(repeat):
+        result = _run_child(path, xml_file, timeout)
+        if 'error' in result:
+            return result
+        if best is None:
+            best = result
+        else:
+            for metric in metrics:
+                best[metric] = min(best[metric], result[metric])
+    return best
+
+
+def deep_sizeof(obj, seen=None):
+    """Returns the number of bytes taken by obj and everything it refers to through containers, instance dictionaries
+    and __slots__.  Objects reachable more than once (e.g. interned strings and shared records) are counted once"""
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, type)) or callable(obj):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (basestring, numbers.Number)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
+
+
+# (<label>, <OIMTopology keyword arguments>) of the topologies compared by memory_report
+memory_modes = [
+    ('dict', {'flyweights': False}),
+    ('dict+intern', {'flyweights': True}),
+    ('compact', {'compact': True, 'flyweights': False}),
+    ('compact+flyweights', {'compact': True, 'flyweights': True}),
+]
+
+
+def memory_report(fixture_paths):
+    """Returns {<fixture name>: {<mode label>: <deep size of the facilities in bytes>}} for every memory_modes
+    topology of each fixture, or {<fixture name>: {'error': <error>}} for fixtures that don't parse"""
+    report = {}
+    for name in sorted(fixture_paths):
+        report[name] = {}
+        try:
+            for label, options in memory_modes:
+                topology = OIMTopology.OIMTopology(fixture_paths[name], **options)
+                topology.parse()
+                report[name][label] = deep_sizeof(topology.facilities)
+        except Exception as e:
+            report[name] = {'error': repr(e)}
+            print '{0:40} ERROR {1}'.format(name, report[name]['error'])
+            continue
+        print '{0:40} {1}'.format(name, '  '.join('{0} {1:9d}'.format(label, report[name][label])
+                                                  for label, _ in memory_modes))
+    return report
+
+
+def make_scaled_fixture(factor, directory):
+    """Writes a copy of scale_fixture with its ResourceGroups repeated factor times (with GroupIDs and names made
+    unique) into directory, and returns its path"""
+    with open(os.path.join(here, scale_fixture), 'rb') as f:
+        data = f.read()
+    blocks = [data[start:end] for _, start, end in OIMTopology.iter_resource_group_blocks(data)]
+
+    path = os.path.join(directory, 'scaled_x{0}.xml'.format(factor))
+    with open(path, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8" ?>\n<ResourceSummary>\n')
+        for i in range(factor):
+            for block in blocks:
+                f.write(block.replace('<GroupID>', '<GroupID>{0}0'.format(i), 1)
+                        .replace('<GroupName>', '<GroupName>x{0} '.format(i), 1))
+        f.write('</ResourceSummary>\n')
+    return path
+
+
+def make_synthetic_fixture(facilities, directory, seed=0):
+    """Writes a generate_OIM_xml document with the given number of facilities into directory, and returns its path"""
+    path = os.path.join(directory, 'synthetic_{0}.xml'.format(facilities))
+    generate_OIM_xml.generate(path, seed, facilities=facilities)
+    return path
+
+
+def run(fixture_paths, path_names, repeat=1, timeout=600):
+    """Returns the benchmark results dictionary for the given {<fixture name>: <file>} and parser paths"""
+    results = {}
+    for name in sorted(fixture_paths):
+        results[name] = {}
+        for path in path_names:
+            results[name][path] = measure(path, fixture_paths[name], repeat, timeout)
+            print '{0:40} {1:10} {2}'.format(name, path, format_result(results[name][path]))
+    return {
+        'meta': {
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'cpus': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'timeout': timeout,
+        },
+        'results': results,
+    }
+
+
+def format_result(result):
+    if 'error' in result:
+        return 'ERROR {0}'.format(result['error'])
+    return 'wall {wall:8.3f}s  cpu {cpu:8.3f}s  peak rss {peak_rss_kb:8d} kB  live objects {live_objects:8d}'.format(
+        **result)
+
+
+def compare(results, baseline, threshold):
+    """Compares results with baseline and returns a list of (<fixture>, <path>, <metric>, <old>, <new>) for every
+    metric that got worse by more than threshold (a fraction, e.g. 0.1 for 10%)"""
+    regressions = []
+    for name, by_path in results['results'].iteritems():
+        for path, result in by_path.iteritems():
+            old = baseline['results'].get(name, {}).get(path)
+            if old is None or 'error' in old or 'error' in result:
+                continue
+            for metric in metrics:
+                # Baselines from before a metric was added (or renamed) have nothing to compare it with
+                if metric not in old:
+                    continue
+                if old[metric] > 0 and result[metric] > old[metric] * (1 + threshold):
+                    regressions.append((name, path, metric, old[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', nargs='*', default=fixtures, help='fixture files to parse')
+    parser.add_argument('--paths', nargs='*', default=sorted(paths), choices=sorted(paths), help='parser paths')
+    parser.add_argument('--scale', nargs='*', type=int, default=[],
+                        help='also parse {0} repeated this many times'.format(scale_fixture))
+    parser.add_argument('--synthetic', nargs='*', type=int, default=[],
+                        help='also parse generate_OIM_xml documents with this many facilities')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per measurement; the best run is kept')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds a run may take before it is killed and recorded as an error (default 600)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='regression threshold (default 0.1 = 10%%)')
+    parser.add_argument('--memory', action='store_true',
+                        help='report the deep size of the parsed topologies instead of timing the parsers')
+    args = parser.parse_args()
+
+    fixture_paths = dict((name, os.path.join(here, name)) for name in args.fixtures)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for factor in args.scale:
+            path = make_scaled_fixture(factor, tmpdir)
+            fixture_paths[os.path.basename(path)] = path
+        for facilities in args.synthetic:
+            path = make_synthetic_fixture(facilities, tmpdir)
+            fixture_paths[os.path.basename(path)] = path
+        if args.memory:
+            results = {'memory': memory_report(fixture_paths)}
+        else:
+            results = run(fixture_paths, args.paths, args.repeat, args.timeout)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline and not args.memory:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, path, metric, old, new in regressions:
+            print 'REGRESSION {0} {1} {2}: {3} -> {4}'.format(name, path, metric, old, new)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions beyond {0:.0%}'.format(args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+""" Generates synthetic OIM rgsummary XML for scaling tests.
+
+The output has the same ResourceSummary/ResourceGroup/Resource shape as resource_group_TEST.xml, so every parser in
+this directory reads it, but the facilities, sites, resources, services, VO ownership, WLCG information and contacts
+are made up from a seeded random number generator.  The same seed and options always give the same file.  The XML is
+written out one resource group at a time as it is generated, so files with hundreds of thousands of resources take no
+more memory than small ones, e.g.
+
+    python generate_OIM_xml.py --facilities 500 --resources-per-group 20 --seed 1 -o big.xml
+"""
+
+import sys
+import random
+import argparse
+from xml.sax.saxutils import escape
+
+contact_types = ['Submitter Contact', 'Security Contact', 'Administrative Contact', 'Miscellaneous Contact',
+                 'Resource Report Contact']
+contact_ranks = ['Primary', 'Secondary', 'Tertiary']
+
+# (<ID>, <Name>, <Description>) of the services resources are given besides CE and Connect
+ce_service = (1, 'CE', 'Compute Element')
+connect_service = (157, 'Connect', 'Connect Glidein Factory')
+other_services = [
+    (3, 'SRMv2', 'SRM V2 Storage Element'),
+    (5, 'GridFtp', 'GridFtp Storage Element'),
+    (130, 'net.perfSONAR.Latency', 'PerfSonar Latency monitoring node'),
+    (131, 'net.perfSONAR.Bandwidth', 'PerfSonar Bandwidth monitoring node'),
+    (109, 'Submit Node', 'OSG Submission Node'),
+    (111, 'Squid', 'Generic squid service'),
+    (101, 'GUMS Server', 'GUMS Server'),
+    (144, 'XRootD component', 'any part of xrootd'),
+]
+
+vos = ['ATLAS', 'CMS', 'OSG', 'Fermilab', 'LIGO', 'GLOW', 'IceCube', 'nova', 'mu2e', 'dune', 'SBGrid', 'HCC',
+       'SURAgrid', 'Engage', 'des']
+
+
+class OIMXMLGenerator(object):
+    """Writes a synthetic rgsummary document.  The attributes are the knobs of the distributions the document is drawn
+    from; counts given as a mean are drawn uniformly from 1 to 2 * mean - 1"""
+    facilities = 10                 # Number of facilities
+    sites_per_facility = 2          # Mean number of sites per facility
+    groups_per_site = 2             # Mean number of resource groups per site
+    resources_per_group = 3         # Mean number of resources per resource group
+    disabled_share = 0.1            # Share of resources with <Disable>True</Disable>
+    ce_share = 0.4                  # Share of resources with a CE service
+    connect_share = 0.02            # Share of resources with a Connect service
+    vos_per_resource = 2            # Mean number of VOs in a resource's VOOwnership
+    wlcg_share = 0.3                # Share of resources with WLCG information available
+    contacts_per_list = 2           # Mean number of contacts in each ContactList
+    support_centers = 20            # Number of support centers the sites are spread across
+    people = 500                    # Number of distinct contact names
+
+    def __init__(self, seed=0, **options):
+        for name, value in options.iteritems():
+            if not hasattr(type(self), name):
+                raise TypeError("Unknown option {0}".format(name))
+            setattr(self, name, value)
+        self.random = random.Random(seed)
+        self.names = ['Person {0}'.format(i) for i in range(self.people)]
+        self.resource_count = 0
+        self.group_count = 0
+
+    def count(self, mean):
+        """Returns a count drawn uniformly from 1 to 2 * mean - 1"""
+        return self.random.randint(1, max(1, 2 * mean - 1))
+
+    def write(self, out):
+        """Writes the document to the file object out"""
+        self.out = out
+        self.pieces = []
+        out.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        self.start('ResourceSummary')
+        site_id = 10000
+        for facility in range(self.facilities):
+            facility_id = 10001 + facility
+            facility_name = 'Facility {0}'.format(facility)
+            for site in range(self.count(self.sites_per_facility)):
+                site_id += 1
+                site_name = 'SITE_{0}_{1}'.format(facility, site)
+                support_center = self.random.randrange(self.support_centers)
+                for _ in range(self.count(self.groups_per_site)):
+                    self.write_resource_group(facility_id, facility_name, site_id, site_name, support_center)
+        self.end('ResourceSummary')
+        self.pieces.append('\n')
+        self.flush()
+
+    def flush(self):
+        """Writes the buffered pieces of the document to the output file.  The document is buffered one resource
+        group at a time, which is far cheaper than writing every tag separately"""
+        self.out.write(''.join(self.pieces))
+        self.pieces = []
+
+    def write_resource_group(self, facility_id, facility_name, site_id, site_name, support_center):
+        self.group_count += 1
+        group_name = '{0}_RG{1}'.format(site_name, self.group_count)
+        self.start('ResourceGroup')
+        self.text('GridType', 'OSG Production Resource')
+        self.text('GroupID', self.group_count)
+        self.text('GroupName', group_name)
+        self.text('Disable', 'False')
+        self.pair('Facility', facility_id, facility_name)
+        self.pair('Site', site_id, site_name)
+        self.pair('SupportCenter', support_center + 1, 'SC_{0}'.format(support_center))
+        self.start('Resources')
+        for _ in range(self.count(self.resources_per_group)):
+            self.write_resource(group_name)
+        self.end('Resources')
+        self.end('ResourceGroup')
+        self.flush()
+
+    def write_resource(self, group_name):
+        self.resource_count += 1
+        rid = self.resource_count
+        disabled = self.random.random() < self.disabled_share
+        self.start('Resource')
+        self.text('ID', rid)
+        self.text('Name', '{0}_R{1}'.format(group_name, rid))
+        self.text('Active', 'True')
+        self.text('Disable', str(disabled))
+
+        services = []
+        if self.random.random() < self.ce_share:
+            services.append(ce_service)
+        if self.random.random() < self.connect_share:
+            services.append(connect_service)
+        if not services or self.random.random() < 0.5:
+            services.append(self.random.choice(other_services))
+        self.start('Services')
+        for service_id, name, description in services:
+            self.start('Service')
+            self.text('ID', service_id)
+            self.text('Name', name)
+            self.text('Description', description)
+            self.start('Details')
+            self.text('hidden', 'False')
+            self.text('uri_override', '')
+            self.end('Details')
+            self.end('Service')
+        self.end('Services')
+
+        fqdn = 'host{0}.{1}.example.org'.format(rid, group_name.lower().replace('_', '-'))
+        self.text('FQDN', fqdn)
+        self.text('FQDNAliases', '')
+
+        self.start('VOOwnership')
+        owners = self.random.sample(vos, min(len(vos), self.count(self.vos_per_resource)))
+        cuts = sorted(self.random.randint(0, 100) for _ in owners[1:])
+        for vo, low, high in zip(owners, [0] + cuts, cuts + [100]):
+            if high > low:
+                self.start('Ownership')
+                self.text('Percent', high - low)
+                self.text('VO', vo)
+                self.end('Ownership')
+        self.end('VOOwnership')
+
+        self.start('WLCGInformation')
+        if self.random.random() < self.wlcg_share:
+            self.text('InteropBDII', 'True')
+            self.text('InteropMonitoring', 'True')
+            self.text('InteropAccounting', 'True')
+            self.text('AccountingName', 'US-{0}'.format(group_name))
+            self.text('KSI2KMin', 0)
+            self.text('KSI2KMax', 100)
+        else:
+            self.pieces.append('(Information not available)')
+        self.end('WLCGInformation')
+
+        self.start('ContactLists')
+        for contact_type in contact_types:
+            self.start('ContactList')
+            self.text('ContactType', contact_type)
+            self.start('Contacts')
+            for _ in range(self.count(self.contacts_per_list)):
+                self.start('Contact')
+                self.text('Name', self.random.choice(self.names))
+                self.text('ContactRank', self.random.choice(contact_ranks))
+                self.end('Contact')
+            self.end('Contacts')
+            self.end('ContactList')
+        self.end('ContactLists')
+        self.end('Resource')
+
+    def start(self, tag):
+        self.pieces.append('<{0}>'.format(tag))
+
+    def end(self, tag):
+        self.pieces.append('</{0}>'.format(tag))
+
+    def text(self, tag, value):
+        """Writes <tag>value</tag>, with value escaped"""
+        self.pieces.append('<{0}>{1}</{0}>'.format(tag, escape(str(value))))
+
+    def pair(self, tag, id, name):
+        """Writes <tag><ID>id</ID><Name>name</Name></tag>"""
+        self.start(tag)
+        self.text('ID', id)
+        self.text('Name', name)
+        self.end(tag)
+
+
+def generate(path, seed=0, **options):
+    """Writes a synthetic rgsummary document to the file path and returns the OIMXMLGenerator that wrote it (its
+    group_count and resource_count say how big it came out).  options are OIMXMLGenerator attributes"""
+    generator = OIMXMLGenerator(seed, **options)
+    with open(path, 'wb') as f:
+        generator.write(f)
+    return generator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='file to write (default: stdout)')
+    parser.add_argument('--seed', type=int, default=0)
+    for name in ('facilities', 'sites_per_facility', 'groups_per_site', 'resources_per_group', 'vos_per_resource',
+                 'contacts_per_list', 'support_centers', 'people'):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=getattr(OIMXMLGenerator, name))
+    for name in ('disabled_share', 'ce_share', 'connect_share', 'wlcg_share'):
+        parser.add_argument('--' + name.replace('_', '-'), type=float, default=getattr(OIMXMLGenerator, name))
+    args = vars(parser.parse_args())
+
+    output = args.pop('output')
+    seed = args.pop('seed')
+    if output is None:
+        generator = OIMXMLGenerator(seed, **args)
+        generator.write(sys.stdout)
+    else:
+        generator = generate(output, seed, **args)
+    print >> sys.stderr, '{0} resource groups, {1} resources'.format(generator.group_count, generator.resource_count)
+
+
+if __name__ == '__main__':
+    main()
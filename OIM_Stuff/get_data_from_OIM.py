@@ -1,4 +1,14 @@
+import os
+import json
+import time
+import urllib
+import datetime
+import tempfile
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 import requests
+from OIMInput import XMLData
 from OIMTopology import OIMTopology
 
 # Note:  URL needs to take into account current date!
@@ -6,20 +16,293 @@ from OIMTopology import OIMTopology
 test_file = 'resource_group_TEST.xml'
 OIM_url = 'http://myosg.grid.iu.edu/rgsummary/xml?summary_attrs_showhierarchy=on&summary_attrs_showwlcg=on&summary_attrs_showservice=on&summary_attrs_showfqdn=on&summary_attrs_showvoownership=on&summary_attrs_showcontact=on&gip_status_attrs_showtestresults=on&downtime_attrs_showpast=&account_type=cumulative_hours&ce_account_type=gip_vo&se_account_type=vo_transfer_volume&bdiitree_type=total_jobs&bdii_object=service&bdii_server=is-osg&start_type=7daysago&start_date=08%2F31%2F2016&end_type=now&end_date=08%2F31%2F2016&all_resources=on&facility_sel%5B%5D=10009&gridtype=on&gridtype_1=on&active=on&active_value=1&disable_value=1'
 
-r = requests.get(OIM_url)
+# Base URL and query of the per-facility rgsummary downloads made by fetch_facilities.  The date range and facility
+# are added by build_url
+OIM_rgsummary_url = 'http://myosg.grid.iu.edu/rgsummary/xml'
+OIM_rgsummary_params = [
+    ('summary_attrs_showhierarchy', 'on'),
+    ('summary_attrs_showwlcg', 'on'),
+    ('summary_attrs_showservice', 'on'),
+    ('summary_attrs_showfqdn', 'on'),
+    ('summary_attrs_showvoownership', 'on'),
+    ('summary_attrs_showcontact', 'on'),
+    ('gip_status_attrs_showtestresults', 'on'),
+    ('downtime_attrs_showpast', ''),
+    ('account_type', 'cumulative_hours'),
+    ('ce_account_type', 'gip_vo'),
+    ('se_account_type', 'vo_transfer_volume'),
+    ('bdiitree_type', 'total_jobs'),
+    ('bdii_object', 'service'),
+    ('bdii_server', 'is-osg'),
+    ('start_type', '7daysago'),
+    ('end_type', 'now'),
+    ('all_resources', 'on'),
+    ('gridtype', 'on'),
+    ('gridtype_1', 'on'),
+    ('active', 'on'),
+    ('active_value', '1'),
+    ('disable_value', '1'),
+]
 
-if r.status_code == requests.codes.ok:
-    with open(test_file, 'w') as f:
-        f.write(r.content)
-else:
-    print "Couldn't get OIM file"
+chunk_size = 64 * 1024
+# (connect, read) timeouts of every request to OIM, in seconds
+request_timeout = (10, 60)
+_session = None
 
 
-topology = OIMTopology(test_file)
-topology.parse()
-topology.test()
+def get_session():
+    """Returns the requests Session shared by every fetch, so connections to OIM are pooled and reused"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
 
 
-# print r.content
+def load_validators(dest):
+    """Returns the ETag/Last-Modified validators stored for dest by the last fetch, or {} if there are none (or dest
+    itself is gone, in which case we need the full body anyway)"""
+    if not os.path.exists(dest):
+        return {}
+    try:
+        with open(dest + '.validators') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
 
+def save_validators(dest, response):
+    """Stores the ETag/Last-Modified validators of response for the next fetch of dest"""
+    validators = {}
+    for header in ('ETag', 'Last-Modified'):
+        if header in response.headers:
+            validators[header] = response.headers[header]
+    with open(dest + '.validators', 'w') as f:
+        json.dump(validators, f)
+
+
+def get_with_retries(session, url, headers, retries=3, backoff=1.0, timeout=request_timeout, stream=False):
+    """Sends a GET request and returns the response.  Connection errors, timeouts and server errors are retried up to
+    retries times with exponential backoff; client errors are raised straight away"""
+    for attempt in range(retries + 1):
+        try:
+            r = session.get(url, headers=headers, stream=stream, timeout=timeout)
+            r.raise_for_status()
+            return r
+        except requests.RequestException as e:
+            if e.response is not None:
+                e.response.close()
+                if e.response.status_code < 500:
+                    raise
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def fetch(url, dest, session=None, retries=3, backoff=1.0, timeout=request_timeout):
+    """Downloads url to dest, unless OIM says it hasn't changed since the last fetch.  The request is conditional on
+    the stored validators and asks for gzip transfer encoding, and the body is streamed in chunks to a temp file that
+    is renamed over dest once complete, so dest is never left half-written.  The request is retried as by
+    get_with_retries.  Returns True if dest was (re)written and False if the content was unchanged (HTTP 304).
+    Raises requests.RequestException if the download fails"""
+    if session is None:
+        session = get_session()
+
+    headers = {'Accept-Encoding': 'gzip'}
+    validators = load_validators(dest)
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+
+    r = get_with_retries(session, url, headers, retries, backoff, timeout, stream=True)
+    try:
+        if r.status_code == requests.codes.not_modified:
+            return False
+
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(chunk_size):
+                    f.write(chunk)
+            os.rename(tmppath, dest)
+        except Exception:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            raise
+        save_validators(dest, r)
+    finally:
+        r.close()
+    return True
+
+
+def build_url(facility_id, start_date=None, end_date=None, base_url=OIM_rgsummary_url):
+    """Returns the rgsummary/xml URL for one facility.  start_date and end_date are datetime.dates, and default to
+    today"""
+    today = datetime.date.today()
+    params = OIM_rgsummary_params + [
+        ('start_date', (start_date or today).strftime('%m/%d/%Y')),
+        ('end_date', (end_date or today).strftime('%m/%d/%Y')),
+        ('facility_sel[]', facility_id),
+    ]
+    return base_url + '?' + urllib.urlencode(params)
+
+
+def fetch_shard(url, session, retries=3, backoff=1.0, timeout=request_timeout):
+    """Downloads one shard and returns its body.  The request is retried as by get_with_retries"""
+    return get_with_retries(session, url, {'Accept-Encoding': 'gzip'}, retries, backoff, timeout).content
+
+
+def fetch_facilities(facility_ids, start_date=None, end_date=None, concurrency=8, retries=3, backoff=1.0,
+                     base_url=OIM_rgsummary_url, topology=None):
+    """Fetches the rgsummary XML of every facility in facility_ids concurrently and parses each one into a single
+    OIMTopology (topology, or a new one) as soon as it arrives.  At most concurrency downloads run at once, over a
+    connection pool of the same size, so the total time is bounded by the slowest shards rather than the sum of all
+    of them.  Returns the topology"""
+    if topology is None:
+        topology = OIMTopology(None)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def fetch_one(facility_id):
+        return fetch_shard(build_url(facility_id, start_date, end_date, base_url), session, retries, backoff)
+
+    pool = ThreadPool(concurrency)
+    try:
+        # Shards are parsed here, in the calling thread, while the rest are still downloading
+        for content in pool.imap_unordered(fetch_one, facility_ids):
+            topology.add_resource_groups(XMLData(content))
+    finally:
+        pool.terminate()
+        session.close()
+    return topology
+
+
+class ChunkReader(object):
+    """File-like object that hands the chunks a downloader thread puts on a bounded queue to whoever reads it, so a
+    parser can consume a response body while it is still being downloaded.  The downloader calls put() with each
+    chunk, then finish() (or fail() with the exception that stopped it)"""
+    def __init__(self, maxchunks=64):
+        self.queue = Queue.Queue(maxchunks)
+        self.buffer = ''
+        self.eof = False
+        self.closed = False
+
+    def put(self, item):
+        """Queues item for the reader, waiting for room.  Gives up if the reader has been closed"""
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def finish(self):
+        self.put(None)
+
+    def fail(self, exc):
+        self.put(exc)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                self.eof = True
+                raise item
+            else:
+                self.buffer += item
+                if size >= 0:
+                    break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+def _download(r, reader, archive):
+    """Downloader thread for fetch_and_parse.  Streams the body of r into reader, and into the file archive (via a
+    temp file that is renamed once the body is complete) if it is not None"""
+    tmppath = None
+    try:
+        f = None
+        if archive is not None:
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive)), suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+        try:
+            for chunk in r.iter_content(chunk_size):
+                if reader.closed:
+                    return
+                if f is not None:
+                    f.write(chunk)
+                reader.put(chunk)
+        finally:
+            if f is not None:
+                f.close()
+        if tmppath is not None:
+            os.rename(tmppath, archive)
+            tmppath = None
+        reader.finish()
+    except Exception as e:
+        reader.fail(e)
+    finally:
+        if tmppath is not None:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+
+def fetch_and_parse(url, topology=None, archive=None, session=None):
+    """Downloads url and parses it into topology (or a new OIMTopology) at the same time.  A downloader thread feeds
+    the response chunks to the streaming parser, which adds each ResourceGroup to the topology as soon as its closing
+    tag arrives, so a usable topology takes about as long as the slower of the download and the parse rather than
+    their sum.  If archive is a file name, the raw bytes are also saved there.  Returns the topology"""
+    if session is None:
+        session = get_session()
+    if topology is None:
+        topology = OIMTopology(None)
+
+    r = session.get(url, headers={'Accept-Encoding': 'gzip'}, stream=True)
+    try:
+        r.raise_for_status()
+        reader = ChunkReader()
+        downloader = threading.Thread(target=_download, args=(r, reader, archive))
+        downloader.daemon = True
+        downloader.start()
+        try:
+            topology.add_resource_groups(reader, streaming=True)
+        finally:
+            reader.close()
+            downloader.join()
+    finally:
+        r.close()
+    return topology
+
+
+def main():
+    try:
+        changed = fetch(OIM_url, test_file)
+    except requests.RequestException:
+        print "Couldn't get OIM file"
+        return
+
+    if not changed:
+        print "OIM file unchanged since the last fetch"
+        return
+
+    topology = OIMTopology(test_file)
+    topology.parse()
+    topology.test()
+
+
+if __name__ == '__main__':
+    main()
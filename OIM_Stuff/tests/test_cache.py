@@ -0,0 +1,68 @@
+""" Round-trip tests of OIMTopologyCache.TopologyCache through OIMTopology.parse(cache=...). """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from OIMTopology import OIMTopology
+from OIMTopologyCache import TopologyCache
+
+TEST_XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource_group_TEST.xml')
+
+
+class TopologyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = TopologyCache(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, xml_file=TEST_XML, cache=None, **options):
+        """Returns the facilities of xml_file and the ParseStats of the parse"""
+        topology = OIMTopology(xml_file, **options)
+        stats = topology.parse(cache=cache, stats=True)
+        return topology.facilities, stats
+
+    def test_round_trip(self):
+        for options in ({}, {'compact': True}):
+            expected, _ = self.parse(**options)
+            facilities, stats = self.parse(cache=self.cache, **options)
+            self.assertEqual(stats.counters['cache_hits'], 0)
+            self.assertEqual(facilities, expected)
+
+            facilities, stats = self.parse(cache=self.cache, **options)
+            self.assertEqual(stats.counters['cache_hits'], 1, options)
+            self.assertEqual(facilities, expected)
+
+    def test_options_and_contents_change_the_key(self):
+        self.parse(cache=self.cache)
+        _, stats = self.parse(cache=self.cache, compact=True)
+        self.assertEqual(stats.counters['cache_hits'], 0)
+
+        xml_file = os.path.join(self.tmpdir, 'resource_group.xml')
+        shutil.copy(TEST_XML, xml_file)
+        with open(xml_file, 'ab') as f:
+            f.write('\n')
+        _, stats = self.parse(xml_file, cache=self.cache)
+        self.assertEqual(stats.counters['cache_hits'], 0)
+
+    def test_corrupt_entry_is_reparsed(self):
+        expected, _ = self.parse(cache=self.cache)
+        key = self.cache.key(TEST_XML)
+        with open(self.cache.path(key), 'r+b') as f:
+            f.seek(-16, os.SEEK_END)
+            f.write('\0' * 16)
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(self.cache.path(key)))
+
+        facilities, stats = self.parse(cache=self.cache)
+        self.assertEqual(stats.counters['cache_hits'], 0)
+        self.assertEqual(facilities, expected)
+        self.assertEqual(self.cache.get(key), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
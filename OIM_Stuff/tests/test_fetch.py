@@ -0,0 +1,104 @@
+""" Tests of the conditional, gzip-encoded downloads of get_data_from_OIM.fetch, against a local stand-in for OIM.
+
+Run from OIM_Stuff with: python -m unittest discover -s tests -t .
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+from StringIO import StringIO
+
+import requests
+
+import get_data_from_OIM
+
+BODY = '<ResourceSummary><ResourceGroup><GroupName>TEST</GroupName></ResourceGroup></ResourceSummary>\n'
+ETAG = '"v1"'
+LAST_MODIFIED = 'Mon, 17 Oct 2016 12:00:00 GMT'
+
+
+def gzipped(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class OIMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves BODY gzip-encoded with an ETag and a Last-Modified, or 304 Not Modified to a request carrying either
+    of them.  The headers of every request are kept in server.requests"""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG or self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = gzipped(BODY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), OIMHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/rgsummary/xml'.format(self.server.server_port)
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'resource_group.xml')
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self):
+        return get_data_from_OIM.fetch(self.url, self.dest, self.session, retries=0)
+
+    def test_200_then_304(self):
+        self.assertTrue(self.fetch())
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        first = self.server.requests[0]
+        self.assertIn('gzip', first['accept-encoding'])
+        self.assertNotIn('if-none-match', first)
+        self.assertNotIn('if-modified-since', first)
+
+        self.assertFalse(self.fetch())
+        second = self.server.requests[1]
+        self.assertEqual(second['if-none-match'], ETAG)
+        self.assertEqual(second['if-modified-since'], LAST_MODIFIED)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+        self.assertEqual([name for name in os.listdir(self.tmpdir) if name.endswith('.tmp')], [])
+
+    def test_missing_dest_is_fetched_in_full(self):
+        self.assertTrue(self.fetch())
+        os.remove(self.dest)
+        self.assertTrue(self.fetch())
+        self.assertNotIn('if-none-match', self.server.requests[1])
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
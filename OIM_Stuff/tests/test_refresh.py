@@ -0,0 +1,77 @@
+""" Tests that OIMTopology.refresh() keeps up with edits to the XML file, checked against a full parse. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from OIMTopology import OIMTopology, RESOURCE_GROUP_BLOCK_RE
+
+TEST_XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource_group_TEST.xml')
+
+
+class RefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xml_file = os.path.join(self.tmpdir, 'resource_group.xml')
+        with open(TEST_XML, 'rb') as f:
+            self.data = f.read()
+        self.blocks = RESOURCE_GROUP_BLOCK_RE.findall(self.data)
+        self.write(self.data)
+        self.topology = OIMTopology(self.xml_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        with open(self.xml_file, 'wb') as f:
+            f.write(data)
+
+    def assertParsed(self):
+        """Checks that the refreshed topology is what a full parse of the file gives"""
+        topology = OIMTopology(self.xml_file)
+        topology.parse()
+        self.assertEqual(self.topology.facilities, topology.facilities)
+
+    def test_first_refresh_is_a_full_parse(self):
+        changes = self.topology.refresh()
+        self.assertEqual(len(changes['added']), len(self.blocks))
+        self.assertParsed()
+        self.assertEqual(self.topology.refresh(), {'added': [], 'changed': [], 'removed': []})
+
+    def test_edits(self):
+        self.topology.refresh()
+        changed, removed, copied = self.blocks[0], self.blocks[1], self.blocks[2]
+        added = copied.replace('<GroupID>', '<GroupID>9999', 1).replace('<GroupName>', '<GroupName>NEW ', 1)
+        data = self.data.replace(changed, changed.replace('<FQDN>', '<FQDN>renamed.', 1)).replace(removed, '')
+        self.write(data.replace('</ResourceSummary>', added + '</ResourceSummary>'))
+
+        changes = self.topology.refresh()
+        self.assertEqual(len(changes['changed']), 1)
+        self.assertEqual(len(changes['removed']), 1)
+        self.assertEqual(len(changes['added']), 1)
+        self.assertParsed()
+
+        self.write(self.data)
+        self.topology.refresh()
+        self.assertParsed()
+
+    def test_blocks_without_a_group_id_of_their_own(self):
+        # A GroupID with an attribute isn't read from the raw block, and a repeated one can't key it
+        hidden = self.blocks[0].replace('<GroupID>', '<GroupID kind="oim">', 1)
+        repeated = self.blocks[1].replace('<GroupName>', '<GroupName>COPY ', 1)
+        data = self.data.replace(self.blocks[0], hidden)
+        self.write(data.replace('</ResourceSummary>', repeated + '</ResourceSummary>'))
+        self.topology.refresh()
+        self.assertParsed()
+
+        self.write(data)
+        changes = self.topology.refresh()
+        self.assertEqual(len(changes['removed']), 1)
+        self.assertEqual(changes['added'], [])
+        self.assertParsed()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+""" Tests that OIMResolver.HostResolver gives the answers of the nested-loop matching it replaced. """
+
+import os
+import unittest
+
+import OIMTopology_NEW
+
+TEST_XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource_group_TEST.xml')
+
+
+def first_match(facilities, resource_name):
+    """The matching of OIMTopology.get_facility_by_resource before HostResolver: returns the (facility, resource
+    group) of the first group whose name is resource_name, or one of whose FQDNs or resource names contains it"""
+    for facility in facilities.values():
+        for resource_group in facility.resource_groups:
+            if resource_group.name.lower() == resource_name.lower():
+                return facility, resource_group
+            for fqdns in resource_group.fqdns:
+                if fqdns.find(resource_name.lower()) >= 0:
+                    return facility, resource_group
+            for resource in resource_group.resources:
+                if resource.name.lower() == resource_name.lower()\
+                        or resource.name.lower().find(resource_name.lower()) >= 0:
+                    return facility, resource_group
+    return None
+
+
+class HostResolverTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.topology = OIMTopology_NEW.OIMTopology(TEST_XML, OIMTopology_NEW.OIMResourceGroupTopology(TEST_XML))
+        cls.facilities = cls.topology.parse()
+
+    def hosts(self):
+        """Whole and partial group names, resource names and FQDNs, in several cases, plus some that match nothing"""
+        hosts = set(['', 'a', 'ce', 'edu', '.edu', 'fnal.gov', 'BNL', 'nonexistent.host'])
+        for facility in self.facilities.values():
+            for resource_group in facility.resource_groups:
+                hosts.update([resource_group.name, resource_group.name.upper()])
+                for fqdn in resource_group.fqdns:
+                    hosts.update([fqdn, fqdn.upper(), fqdn.split('.', 1)[-1], fqdn[2:9], fqdn[-7:]])
+                for resource in resource_group.resources:
+                    hosts.update([resource.name, resource.name[:-1], resource.name[1:4], resource.name[:2]])
+        return sorted(hosts)
+
+    def test_get_facility_by_resource(self):
+        self.assertTrue(self.facilities)
+        for host in self.hosts():
+            expected = first_match(self.facilities, host)
+            self.assertIs(self.topology.get_facility_by_resource(host), expected and expected[0], host)
+
+    def test_get_resource_group_by_resource(self):
+        for facility in self.facilities.values():
+            for host in self.hosts():
+                expected = first_match({facility.name: facility}, host)
+                self.assertIs(facility.get_resource_group_by_resource(host), expected and expected[1], host)
+
+
+if __name__ == '__main__':
+    unittest.main()
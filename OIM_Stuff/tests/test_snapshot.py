@@ -0,0 +1,76 @@
+""" Tests that an OIMSnapshot.TopologySnapshot answers lookups as the topology and HostResolver it was written from. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from OIMTopology import OIMTopology
+from OIMResolver import HostResolver
+from OIMSnapshot import write_snapshot, TopologySnapshot
+
+TEST_XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource_group_TEST.xml')
+
+
+def _ids(ids):
+    """Returns the IDs HostResolver.resolve_ids returns as ints, as TopologySnapshot.resolve_ids does"""
+    return tuple(int(i) if i is not None else None for i in ids)
+
+
+class TopologySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def snapshot(self, **options):
+        """Returns the facilities parsed with options and a TopologySnapshot of them"""
+        topology = OIMTopology(TEST_XML, **options)
+        topology.parse()
+        path = os.path.join(self.tmpdir, 'topology.snap')
+        write_snapshot(topology.facilities, path)
+        return topology.facilities, TopologySnapshot(path)
+
+    def hosts(self, facilities):
+        """Whole and partial group names, resource names and FQDNs, in several cases, plus some that match nothing"""
+        hosts = set(['', 'a', 'x', '.gov', 'nonexistent.host'])
+        for facility in facilities.values():
+            for site in facility['Sites'].values():
+                for resource_group in site['ResourceGroups'].values():
+                    hosts.update([resource_group['Name'], resource_group['Name'].upper()])
+                    for resource in resource_group['Resources'].values():
+                        hosts.update([resource['Name'], resource['Name'][:5].upper(), resource['FQDN'],
+                                      resource['FQDN'][2:9]])
+        return sorted(hosts)
+
+    def test_resolve_ids(self):
+        for options in ({}, {'compact': True}):
+            facilities, snapshot = self.snapshot(**options)
+            with snapshot:
+                resolver = HostResolver.from_facility_dicts(facilities)
+                for host in self.hosts(facilities):
+                    self.assertEqual(snapshot.resolve_ids(host), _ids(resolver.resolve_ids(host)), host)
+
+    def test_lookups(self):
+        facilities, snapshot = self.snapshot()
+        with snapshot:
+            count = 0
+            for facility in facilities.values():
+                for site in facility['Sites'].values():
+                    for resource_group in site['ResourceGroups'].values():
+                        for resource in resource_group['Resources'].values():
+                            count += 1
+                            found = snapshot.resource_by_id(resource['ID'])
+                            self.assertEqual((found.name, found.fqdn, found.group, found.site, found.facility),
+                                             (resource['Name'], resource['FQDN'], resource_group['Name'],
+                                              site['Name'], facility['Name']))
+                            self.assertEqual(snapshot.resource_by_fqdn(resource['FQDN'].upper()).fqdn.lower(),
+                                             resource['FQDN'].lower())
+            self.assertEqual(snapshot.count('resources'), count)
+            self.assertIsNone(snapshot.resource_by_fqdn('nonexistent.host'))
+
+
+if __name__ == '__main__':
+    unittest.main()